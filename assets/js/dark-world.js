@@ -853,8 +853,21 @@ HANDLERS = {
     'update': on_update,
     'sound': on_sound,
     'dialog': on_dialog,
+    'batch': function (params) {
+        for (let msg of params.msgs) {
+            dispatch(msg);
+        }
+    },
 };
 
+function dispatch(params) {
+    let h = HANDLERS[params.op];
+    if (!h) {
+        throw "no handler for " + params.op;
+    }
+    h(params);
+}
+
 var messages = $('<ul id="messages">').appendTo(document.body);
 
 function connect() {
@@ -869,12 +882,7 @@ function connect() {
         });
     };
     ws.onmessage = function (event) {
-        let params = JSON.parse(event.data);
-        let h = HANDLERS[params.op];
-        if (!h) {
-            throw "no handler for " + params.op;
-        }
-        h(params);
+        dispatch(JSON.parse(event.data));
     };
     ws.onclose = function (event) {
         log('Connection closed: ' + event.code + ' ' + event.reason, 'error');
@@ -0,0 +1,250 @@
+"""Benchmarks for parts of the server."""
+import asyncio
+import json
+import sys
+from timeit import Timer
+
+import click
+
+from darkworld import backends
+
+
+def sample_messages():
+    """Construct messages like those the server sends most often."""
+    from darkworld.actor import Enemy, Plant
+    from darkworld.coords import Direction
+
+    enemy = Enemy('enemies/bat', 10, 2)
+    enemy.pos = (12, -7)
+    plants = []
+    for i in range(200):
+        plant = Plant(Plant.PLANTS[i % len(Plant.PLANTS)])
+        plant.pos = (i % 17, i // 17)
+        plant.direction = Direction.EAST
+        plants.append(plant)
+
+    return {
+        'moved': {
+            'op': 'moved',
+            'obj': enemy.to_json(),
+            'from_pos': (12, -7),
+            'to_pos': (12, -6),
+            'track': False,
+        },
+        'setvalue': {'op': 'setvalue', 'health': 27},
+        'refresh': {
+            'op': 'refresh',
+            'world': {'title': 'The Light World', 'sun_intensity': 1},
+            'pos': (0, 0),
+            'objs': [p.to_json() for p in plants],
+            'gold': 100,
+            'health': 30,
+        },
+    }
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--number', default=10000, help='Messages to encode per run.')
+def codec(number):
+    """Measure the cost of encoding and decoding each message."""
+    messages = sample_messages()
+    for name, (dumps, loads) in backends.CODECS.items():
+        for op, msg in messages.items():
+            encoded = dumps(msg)
+            n = max(1, number // (len(encoded) // 100 + 1))
+            enc = min(Timer(lambda: dumps(msg)).repeat(3, n)) / n
+            dec = min(Timer(lambda: loads(encoded)).repeat(3, n)) / n
+            print(
+                f'{name:8} {op:10} {len(encoded):6} bytes  '
+                f'encode {enc * 1e6:8.2f}us  decode {dec * 1e6:8.2f}us'
+            )
+
+
+@cli.command()
+@click.argument('recording', type=click.Path(exists=True, file_okay=False))
+@click.option('--speed', type=float, default=None,
+              help='Run this many times faster than real time '
+                   '(default: as fast as possible).')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Write the report as JSON to this file.')
+def replay(recording, speed, output):
+    """Replay a recorded session and report the work done."""
+    from darkworld.replay import replay as run_replay
+
+    report = asyncio.get_event_loop().run_until_complete(
+        run_replay(recording, speed=speed)
+    )
+    print(
+        f"{report['ticks']} ticks ({report['simulated_seconds']:.1f}s) "
+        f"in {report['wall_seconds']:.2f}s, "
+        f"{report['cpu_seconds']:.2f}s CPU"
+    )
+    print(f"{report['messages_received']} messages received")
+    for op, n in report['messages_sent'].items():
+        size = report['bytes_sent'].get(op, 0)
+        print(f'{op:12} {n:8} messages {size:10} bytes')
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+@cli.command()
+@click.option('--hours', default=24.0, show_default=True,
+              help='Hours of simulated time to run for.')
+@click.option('--players', default=10, show_default=True,
+              help='Number of simulated players.')
+@click.option('--rate', default=0.2, show_default=True,
+              help='Actions per second of simulated time per player.')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed for the world and the players\' choices.')
+@click.option('--savedir', type=click.Path(file_okay=False), default=None,
+              help='Save the game here (default: a scratch directory).')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Write the report as JSON to this file.')
+def simulate(hours, players, rate, seed, savedir, output):
+    """Simulate the game headlessly, faster than real time."""
+    from darkworld.simulation import simulate
+
+    report = asyncio.get_event_loop().run_until_complete(simulate(
+        hours * 3600,
+        players=players,
+        rate=rate,
+        seed=seed,
+        savedir=savedir,
+    ))
+    print(
+        f"{report['simulated_seconds'] / 3600:.1f} hours in "
+        f"{report['wall_seconds']:.1f}s ({report['speedup']:.0f}x), "
+        f"{report['cpu_seconds']:.1f}s CPU"
+    )
+    ticks = report['tick_ms']
+    print(
+        f"{report['ticks_run']} ticks run, {report['ticks_skipped']} skipped; "
+        f"mean {ticks['mean']:.2f}ms p99 {ticks['p99']:.2f}ms "
+        f"max {ticks['max']:.2f}ms"
+    )
+    print(
+        f"{report['actions']} actions by {report['players']} players, "
+        f"{report['teleports']} teleports, "
+        f"{report['dark_worlds_created']} dark worlds created"
+    )
+    for op, n in report['messages_sent'].items():
+        print(f'    {op:12} {n:10} messages')
+    print()
+    print(f"{'hour':>6} {'rss MB':>8} {'counted MB':>10} "
+          f"{'worlds':>6} {'actors':>8}")
+    for m in report['memory']:
+        print(
+            f"{m['time'] / 3600:6.1f} {m['rss'] / 2 ** 20:8.1f} "
+            f"{m['accounted'] / 2 ** 20:10.1f} {m['worlds']:6} "
+            f"{m['actors']:8}"
+        )
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+@cli.command()
+@click.option('--cycles', default=20, show_default=True,
+              help='Number of visits to dark worlds.')
+@click.option('--players', default=4, show_default=True,
+              help='Number of players in each visit, up to 4.')
+@click.option('--stay', default=60.0, show_default=True,
+              help='Seconds of simulated time to spend in each dark world.')
+@click.option('--max-growth', default=32.0, show_default=True,
+              help='Megabytes the process may grow by after warming up.')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed for the world and the players\' choices.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Write the report as JSON to this file.')
+def soak(cycles, players, stay, max_growth, seed, output):
+    """Check that dark worlds are freed after their players leave."""
+    from darkworld.soak import soak
+
+    def progress(cycle, rss, leaks):
+        print(f'cycle {cycle + 1:4}: rss {rss / 2 ** 20:7.1f}MB, '
+              f'{len(leaks)} leaked objects')
+
+    report = asyncio.get_event_loop().run_until_complete(soak(
+        cycles,
+        progress,
+        players=players,
+        stay=stay,
+        seed=seed,
+        max_growth=max_growth * 2 ** 20,
+    ))
+    for leak in report['leaks']:
+        print(f"Leaked {leak['object']} from cycle {leak['cycle'] + 1}:")
+        for r in leak['referrers']:
+            print(f'    {r}')
+    if report['live_instances']:
+        print('Instances still live:', ', '.join(report['live_instances']))
+    print(
+        f"{report['visits']} visits, "
+        f"growth after warmup {report['growth'] / 2 ** 20:.1f}MB: "
+        + ('PASS' if report['passed'] else 'FAIL')
+    )
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not report['passed']:
+        sys.exit(1)
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            break
+    return f'{seconds * scale:8.2f}{unit:2}'
+
+
+@cli.command()
+@click.option('--filter', 'pattern', default='*',
+              help='Run only benchmarks matching this glob pattern.')
+@click.option('--repeat', default=5, help='Number of timing runs.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Save the results as JSON, to use as a baseline.')
+def micro(pattern, repeat, output):
+    """Run the microbenchmarks of the world and AI hot paths."""
+    from darkworld import benchmarks
+
+    def progress(name, result):
+        print(
+            f"{name:20} best {format_time(result['best'])} "
+            f"median {format_time(result['median'])} "
+            f"({result['number']} loops)"
+        )
+
+    results = benchmarks.run(pattern, repeat, progress)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+@cli.command()
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--tolerance', default=0.1, show_default=True,
+              help='Relative slowdown to allow before failing.')
+def compare(baseline, current, tolerance):
+    """Compare two microbenchmark results, failing on regressions."""
+    from darkworld import benchmarks
+
+    rows = benchmarks.compare(json.load(baseline), json.load(current),
+                              tolerance)
+    for name, base, cur, ratio, verdict in rows:
+        print(
+            f'{name:20} {format_time(base)} -> {format_time(cur)} '
+            f'{ratio:6.2f}x {verdict}'
+        )
+    if any(verdict == 'slower' for *_, verdict in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
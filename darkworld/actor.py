@@ -1,13 +1,12 @@
 """Actors are objects that can exist in the world."""
 import uuid
-import asyncio
 import weakref
 import random
 
-from .asyncutils import start_coroutine
 from .coords import Direction, adjacent, Rect, random_dir
 from .world import Collision
 from .items import InsufficientItems
+from .scheduler import ticker
 
 
 class Actor:
@@ -178,8 +177,7 @@ class PC(Mob):
             'health': 0
         })
         self.client.text_message('You are dead. Game over.')
-        loop = asyncio.get_event_loop()
-        loop.call_later(
+        ticker.main.call_later(
             5.0,
             self.client.respawn,
             'Welcome back to the land of the living.'
@@ -230,8 +228,9 @@ class Enemy(Mob):
 
     def on_death(self):
         from .items import generate_loot
-        if random.random() < 0.6:
-            loot = generate_loot()
+        rng = self.world.rng
+        if rng.random() < 0.6:
+            loot = generate_loot(rng)
             loot.spawn(self.world, self.pos, effect='drop')
 
     def to_json(self):
@@ -294,33 +293,39 @@ class Teleporter(Standable):
             return
         if not self.have_trigger:
             obj.alive = False
-            loop = asyncio.get_event_loop()
-            loop.call_later(0.2, self.teleport)
+            ticker.main.call_later(0.2, self.teleport)
 
     def _target(self):
         """Get the target world to teleport to."""
         if self.target:
             return self.target
         else:
-            from .world_gen import create_dark_world
-            return create_dark_world()
+            from .instances import worlds
+            return worlds.get_dark_world()
 
-    @start_coroutine
-    async def teleport(self, target=None, pos=(0, 0)):
+    def teleport(self, target=None, pos=(0, 0)):
         obj = self.world.get(self.pos)
         if not isinstance(obj, PC):
             return
-        obj.kill(effect='teleport')
-        client = obj.client
-        client.play_sound('teleport')
         target = target or self._target()
+        if not target:
+            obj.alive = True
+            obj.client.text_message('The dark world is full. Try again later.')
+            return
+        obj.kill(effect='teleport')
+        obj.client.play_sound('teleport')
+        ticker.main.call_later(1.0, self._arrive, obj, target, pos)
 
-        await asyncio.sleep(1.0)
+    def _arrive(self, obj, target, pos):
+        if getattr(target, 'remote', False):
+            # The world is run by another process
+            target.admit(obj, pos)
+            return
         # FIXME: we need to identify spawn point before we restart sight
         obj.world = target
         obj.pos = pos
         obj.client.handle_refresh()
-        client.sight.restart()
+        obj.client.sight.restart()
         try:
             obj.spawn(target, pos=pos, effect='teleport')
         except Collision:
@@ -349,7 +354,8 @@ class Trigger(Scenery):
                 y -= self.pos[1]
                 to_teleport.append((t, (x, y)))
 
-        if not pc.client.can('developer'):
+        paid = not pc.client.can('developer')
+        if paid:
             try:
                 pc.client.inventory.take('mushroom', 2)
             except InsufficientItems as e:
@@ -360,8 +366,16 @@ class Trigger(Scenery):
                 return
 
         if to_teleport:
-            from .world_gen import create_dark_world
-            target = create_dark_world()
+            from .instances import worlds
+            target = worlds.get_dark_world(len(to_teleport))
+            if not target:
+                if paid:
+                    # Nobody is going anywhere, so refund them
+                    pc.client.inventory.add('mushroom', 2)
+                pc.client.text_message(
+                    'The dark world is full. Try again later.'
+                )
+                return
             for teleporter, pos in to_teleport:
                 teleporter.teleport(target, pos)
         else:
@@ -422,8 +436,9 @@ class Chest(Scenery):
         super().__init__('chest')
 
     def on_act(self, pc):
+        rng = self.world.rng
         self.kill(effect='fade')
-        amount = random.randint(10, 20)
+        amount = rng.randint(10, 20)
         pc.client.text_message(f'The chest contains {amount} gold.')
         pc.client.gold += amount
 
@@ -1,16 +1,46 @@
-import asyncio
 import random
-from collections import defaultdict
+from collections import defaultdict, deque
 import heapq
 
 from .coords import (
-    random_dir, Direction, adjacent, manhattan_distance, neighbours,
-    direction_to
+    ALL_DIRECTIONS, Direction, adjacent, manhattan_distance, neighbours,
+    direction_to, Rect
 )
-from .world import Collision
-from .actor import PC, Enemy
+from .actor import PC, Enemy, Mob
+from .navigation import is_obstacle, find_path
+from .scheduler import ESSENTIAL
 
-loop = asyncio.get_event_loop()
+import numpy as np
+
+# Seconds between each think
+THINK_INTERVAL = 0.5
+
+# Enemies give up the chase beyond this distance
+CHASE_RADIUS = 7
+
+# Flow fields extend this far from their goal, so that chasers can follow
+# routes that leave the chase radius, such as around walls
+FIELD_RADIUS = 2 * CHASE_RADIUS
+
+# Idle enemies notice PCs closer than this
+AGGRO_RADIUS = 6
+
+# Chance per think that an idle enemy wanders instead of looking for a target
+WANDER_CHANCE = 0.2
+
+# Groups of at least this many enemies use VectorEnemyAI
+VECTOR_THRESHOLD = 200
+
+
+def create_ai(enemies, seed=None, size=None):
+    """Create the most suitable AI for a group of enemies.
+
+    `size` is the number of enemies expected, if they will be spawned later.
+
+    """
+    if (size or len(enemies)) >= VECTOR_THRESHOLD:
+        return VectorEnemyAI(enemies, np.random.default_rng(seed))
+    return EnemyAI(enemies, random.Random(seed))
 
 
 class All:
@@ -22,13 +52,30 @@ class All:
 class EnemyAI:
     """An AI for a group of enemies."""
 
-    def __init__(self, enemies=[]):
+    def __init__(self, enemies=[], rng=random):
         self.enemies = {e: None for e in enemies}
+        self.rng = rng
         self.targets = defaultdict(set)
+        self.fields = {}
         self.rect = All()
 
+    def __len__(self):
+        return len(self.enemies)
+
+    def attach(self, world):
+        """Start controlling the enemies in world."""
+        world.subscribe(self)
+        world.scheduler.add_system(
+            self.think,
+            THINK_INTERVAL,
+            priority=ESSENTIAL // 2,
+            name='ai'
+        )
+
     def moved(self, obj, from_pos, to_pos):
         if isinstance(obj, PC):
+            if from_pos != to_pos:
+                self.fields.pop(obj, None)
             self.check_adj(obj)
 
     def check_adj(self, obj):
@@ -51,22 +98,57 @@ class EnemyAI:
 
     def spawned(self, obj, pos, effect):
         if isinstance(obj, Enemy):
-            self.enemies.add(obj)
+            self.enemies[obj] = None
 
         if isinstance(obj, PC):
-            if not self.targets:
-                loop.call_later(3, self.think)
             self.targets[obj] = set()
 
+        if not isinstance(obj, Mob):
+            self.invalidate_fields(pos)
+
     def killed(self, obj, pos, effect):
         self.enemies.pop(obj, None)
+        self.fields.pop(obj, None)
 
         for e in self.targets.pop(obj, ()):
             self.enemies[e] = None
 
+        if not isinstance(obj, Mob):
+            self.invalidate_fields(pos)
+
+    def invalidate_fields(self, pos):
+        """Discard flow fields that could route through pos."""
+        for target, field in list(self.fields.items()):
+            if pos in field.rect:
+                del self.fields[target]
+
+    def get_field(self, target):
+        """Get the flow field leading to target, computing it if needed."""
+        field = self.fields.get(target)
+        if field is None:
+            field = self.fields[target] = FlowField(target.world, target.pos)
+        return field
+
+    def chase_step(self, e, target):
+        """Get the next step for enemy e to take towards target, if any.
+
+        Enemies outside the target's flow field plan a path of their own.
+
+        """
+        field = self.get_field(target)
+        if e.pos in field.dist:
+            return field.next_step(e.world, e.pos)
+        path = find_path(e.world, e.pos, target.pos)
+        if not path:
+            return None
+        obj = e.world.get(path[0])
+        if obj is not None and not obj.standable:
+            return None
+        return path[0]
+
     def think(self):
-        if self.targets and self.enemies:
-            loop.call_later(0.5, self.think)
+        if not self.targets:
+            return
 
         all_targets = list(self.targets)
         for e, target in list(self.enemies.items()):
@@ -76,30 +158,248 @@ class EnemyAI:
                 dist = manhattan_distance(e.pos, target.pos)
                 if dist == 1:
                     e.face(target)
-                    target.hit(random.randint(1, e.damage))
-                elif dist > 7:
+                    target.hit(self.rng.randint(1, e.damage))
+                elif dist > CHASE_RADIUS:
                     # Lost target
                     self.enemies[e] = None
                 else:
-                    if not getattr(e, '_path', None):
-                        path = a_star_search(e.world, e.pos, target.pos)
-                        e._path = path
-                    step = e._path.pop()
-                    d = direction_to(e.pos, step)
-                    try:
-                        e.move_step(d)
-                    except Collision:
-                        e._path = None
-            elif random.random() < 0.2:
+                    step = self.chase_step(e, target)
+                    if step:
+                        e.move_step(direction_to(e.pos, step))
+            elif self.rng.random() < WANDER_CHANCE:
                 # random walk
-                e.move_step(random_dir())
+                e.move_step(self.rng.choice(ALL_DIRECTIONS))
             elif all_targets:
-                t = random.choice(all_targets)
-                if manhattan_distance(e.pos, t.pos) < 6:
+                t = self.rng.choice(all_targets)
+                if manhattan_distance(e.pos, t.pos) < AGGRO_RADIUS:
                     self.enemies[e] = t
                     self.targets[t].add(e)
 
 
+class VectorEnemyAI(EnemyAI):
+    """An AI for a large group of enemies, using numpy.
+
+    Enemy state is held as a structure of arrays indexed by enemy, and PCs
+    occupy slots in a parallel list. Each think computes distances, attacks,
+    lost targets, wandering and aggro for the whole group at once; only the
+    resulting moves and attacks touch the actors themselves.
+
+    Health stays on the Enemy objects, because Mob.hit() is what changes it.
+
+    """
+
+    def __init__(self, enemies=[], rng=None):
+        self.targets = defaultdict(set)
+        self.fields = {}
+        self.rect = All()
+        self.rng = rng or np.random.default_rng()
+        self.pcs = []
+        self.pc_slots = {}
+        self._set_enemies(list(enemies))
+
+    def _set_enemies(self, enemies):
+        self.actors = enemies
+        self.index = {e: i for i, e in enumerate(enemies)}
+        n = len(enemies)
+        self.pos = np.array([e.pos for e in enemies], dtype=np.int32)
+        self.pos.shape = (n, 2)
+        self.damage = np.array([e.damage for e in enemies], dtype=np.int32)
+        self.alive = np.array([e.alive for e in enemies], dtype=bool)
+        self.target = np.full(n, -1, dtype=np.int32)
+        self.dead = 0
+
+    def _add_enemy(self, e):
+        self.index[e] = len(self.actors)
+        self.actors.append(e)
+        self.pos = np.append(self.pos, [e.pos], axis=0)
+        self.damage = np.append(self.damage, e.damage)
+        self.alive = np.append(self.alive, True)
+        self.target = np.append(self.target, -1)
+
+    def _compact(self):
+        """Drop dead enemies from the arrays, keeping their targets."""
+        keep = np.flatnonzero(self.alive)
+        target = self.target[keep]
+        self._set_enemies([self.actors[i] for i in keep])
+        self.target = target
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    @property
+    def enemies(self):
+        """Map live enemies to the PC each is targeting, if any."""
+        return {
+            self.actors[i]: self.target_of(i)
+            for i in np.flatnonzero(self.alive)
+        }
+
+    def moved(self, obj, from_pos, to_pos):
+        i = self.index.get(obj)
+        if i is not None:
+            self.pos[i] = to_pos
+        elif isinstance(obj, PC):
+            if from_pos != to_pos:
+                self.fields.pop(obj, None)
+            self.check_adj(obj)
+
+    def check_adj(self, obj):
+        slot = self.pc_slots.get(obj)
+        if slot is None:
+            return
+        dist = np.abs(self.pos - obj.pos).sum(axis=1)
+        adj = np.flatnonzero(self.alive & (dist == 1))
+        self.target[adj] = slot
+        self.targets[obj].update(self.actors[i] for i in adj)
+
+    def spawned(self, obj, pos, effect):
+        if isinstance(obj, Enemy):
+            self._add_enemy(obj)
+
+        if isinstance(obj, PC):
+            self.targets[obj] = set()
+            try:
+                slot = self.pcs.index(None)
+            except ValueError:
+                slot = len(self.pcs)
+                self.pcs.append(obj)
+            else:
+                self.pcs[slot] = obj
+            self.pc_slots[obj] = slot
+
+        if not isinstance(obj, Mob):
+            self.invalidate_fields(pos)
+
+    def killed(self, obj, pos, effect):
+        i = self.index.pop(obj, None)
+        if i is not None:
+            self.alive[i] = False
+            self.target[i] = -1
+            self.dead += 1
+            if self.dead > len(self.actors) // 2:
+                self._compact()
+
+        self.fields.pop(obj, None)
+        self.targets.pop(obj, None)
+        slot = self.pc_slots.pop(obj, None)
+        if slot is not None:
+            self.pcs[slot] = None
+            self.target[self.target == slot] = -1
+
+        if not isinstance(obj, Mob):
+            self.invalidate_fields(pos)
+
+    def think(self):
+        if not self.targets:
+            return
+
+        n = len(self.actors)
+        pc_pos = np.array(
+            [pc.pos if pc else (0, 0) for pc in self.pcs],
+            dtype=np.int32
+        )
+        pc_alive = np.array([bool(pc and pc.alive) for pc in self.pcs])
+        live_slots = np.flatnonzero(pc_alive)
+
+        has_target = self.alive & (self.target >= 0)
+        has_target[has_target] = pc_alive[self.target[has_target]]
+        dist = np.abs(self.pos - pc_pos[self.target]).sum(axis=1)
+
+        attack = np.flatnonzero(has_target & (dist == 1))
+        lost = has_target & (dist > CHASE_RADIUS)
+        chase = np.flatnonzero(has_target & (dist > 1) & ~lost)
+        self.target[lost] = -1
+
+        idle = self.alive & ~has_target
+        wander = idle & (self.rng.random(n) < WANDER_CHANCE)
+        acquire = np.zeros(n, dtype=bool)
+        if live_slots.size:
+            choice = live_slots[self.rng.integers(live_slots.size, size=n)]
+            aggro_dist = np.abs(self.pos - pc_pos[choice]).sum(axis=1)
+            acquire = idle & ~wander & (aggro_dist < AGGRO_RADIUS)
+            self.target[acquire] = choice[acquire]
+
+        # Apply the results to the actors
+        rolls = self.rng.integers(1, self.damage[attack] + 1)
+        for i, dmg in zip(attack, rolls):
+            target = self.target_of(i)
+            if target:
+                self.actors[i].face(target)
+                target.hit(int(dmg))
+
+        for i in chase:
+            e = self.actors[i]
+            target = self.target_of(i)
+            if not target:
+                continue
+            step = self.chase_step(e, target)
+            if step:
+                e.move_step(direction_to(e.pos, step))
+
+        wanderers = np.flatnonzero(wander)
+        dirs = self.rng.integers(len(Direction), size=wanderers.size)
+        for i, d in zip(wanderers, dirs):
+            self.actors[i].move_step(Direction(d))
+
+        for i in np.flatnonzero(acquire):
+            target = self.target_of(i)
+            if target:
+                self.targets[target].add(self.actors[i])
+
+    def target_of(self, i):
+        """Get the PC that enemy i is targeting, if any."""
+        slot = self.target[i]
+        return self.pcs[slot] if slot >= 0 else None
+
+
+class FlowField:
+    """Path distances to a goal, shared by every enemy chasing it.
+
+    The field is a breadth-first search out from the goal over the square of
+    `radius` tiles around it. Any enemy within the field can then find its
+    next step by comparing the distances of its neighbours.
+
+    """
+    def __init__(self, world, goal, radius=FIELD_RADIUS):
+        self.goal = goal
+        self.rect = Rect.from_center(goal, radius)
+        self.dist = dist = {goal: 0}
+        nav = world.nav
+        edge = deque([goal])
+        while edge:
+            pos = edge.popleft()
+            d = dist[pos] + 1
+            for p in neighbours(pos):
+                if p in dist or p not in self.rect:
+                    continue
+                if nav and not nav.passable(p):
+                    continue
+                if is_obstacle(world.get(p)):
+                    continue
+                dist[p] = d
+                edge.append(p)
+
+    def next_step(self, world, pos):
+        """Get the free neighbour of pos that is closest to the goal.
+
+        Return None if there is no way to get closer right now.
+
+        """
+        best = None
+        best_dist = self.dist.get(pos)
+        if best_dist is None:
+            return None
+        for p in neighbours(pos):
+            d = self.dist.get(p)
+            if d is None or d >= best_dist:
+                continue
+            obj = world.get(p)
+            if obj is not None and not obj.standable:
+                continue
+            best, best_dist = p, d
+        return best
+
+
 # Code below taken from Red Blob Games
 
 
@@ -1,7 +1,11 @@
 """Utilities for working with asyncio."""
 
 import asyncio
+import types
 from functools import wraps
+from timeit import default_timer
+
+from . import metrics
 
 
 def start_coroutine(func):
@@ -13,5 +17,48 @@ def start_coroutine(func):
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        asyncio.ensure_future(func(*args, **kwargs))
+        asyncio.ensure_future(
+            timed(func(*args, **kwargs), 'task', func.__qualname__)
+        )
     return wrapper
+
+
+async def timed(coro, kind, name, **context):
+    """Await a coroutine, recording how long it holds the event loop.
+
+    Time spent waiting does not count. The total is recorded with
+    metrics.record(), and any single step that blocks the loop for too long
+    is logged as slow.
+
+    """
+    return await _timed_steps(coro, kind, name, context)
+
+
+@types.coroutine
+def _timed_steps(coro, kind, name, context):
+    busy = 0.0
+    value = error = None
+    try:
+        while True:
+            start = default_timer()
+            try:
+                if error is None:
+                    yielded = coro.send(value)
+                else:
+                    yielded = coro.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                step = default_timer() - start
+                busy += step
+                if step > metrics.SLOW_THRESHOLD:
+                    metrics.log_slow(kind, name, step, **context)
+            try:
+                value, error = (yield yielded), None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
+    finally:
+        metrics.latency[kind].observe(busy, name)
@@ -0,0 +1,58 @@
+"""Faster implementations of JSON and the event loop, where installed.
+
+orjson and uvloop are optional. select() is called once at startup to pick
+the best available of each, falling back to the standard library, and
+reports the choice. Code that encodes or decodes messages should call
+backends.dumps() and backends.loads() so that it uses the selected codec.
+
+"""
+import asyncio
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+def orjson_dumps(obj):
+    """Encode obj to a JSON string with orjson."""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+# Available JSON codecs, best first, as (dumps, loads) pairs
+CODECS = {}
+if orjson:
+    CODECS['orjson'] = (orjson_dumps, orjson.loads)
+CODECS['json'] = (json.dumps, json.loads)
+
+# Available event loop policies, best first
+LOOP_POLICIES = {}
+if uvloop:
+    LOOP_POLICIES['uvloop'] = uvloop.EventLoopPolicy
+LOOP_POLICIES['asyncio'] = asyncio.DefaultEventLoopPolicy
+
+codec = 'json'
+dumps, loads = CODECS[codec]
+loop_policy = 'asyncio'
+
+
+def select(codec_name=None, loop_name=None):
+    """Choose the JSON codec and event loop policy to use.
+
+    This must be called before the event loop is created. By default the
+    best available backends are chosen.
+
+    """
+    global codec, dumps, loads, loop_policy
+    codec = codec_name or next(iter(CODECS))
+    dumps, loads = CODECS[codec]
+
+    loop_policy = loop_name or next(iter(LOOP_POLICIES))
+    asyncio.set_event_loop_policy(LOOP_POLICIES[loop_policy]())
+    print(f'Using {codec} for JSON and the {loop_policy} event loop')
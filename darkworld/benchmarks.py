@@ -0,0 +1,284 @@
+"""Microbenchmarks of the world and AI hot paths.
+
+Each benchmark is a function that builds its fixtures and returns a callable
+to time. If the callable has a teardown attribute, it is called afterwards
+to undo any changes to global state. Fixtures are generated from fixed seeds, so results are comparable
+between builds. Run them and compare results with bench.py.
+
+"""
+import contextlib
+import io
+import platform
+import random
+import statistics
+import tempfile
+from fnmatch import fnmatch
+from pathlib import Path
+from timeit import Timer
+
+from .coords import Rect
+from .world import World, Subscriber
+
+
+# Registered benchmarks, by name
+BENCHMARKS = {}
+
+# Fractions of cells filled, for benchmarks that depend on crowding
+DENSITIES = (0.1, 0.5, 0.9)
+
+# Default relative slowdown before a benchmark counts as a regression
+TOLERANCE = 0.1
+
+
+def benchmark(name):
+    """Register a benchmark setup function under the given name."""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def populated_world(density, size=40, seed=0):
+    """Create a world with plants in the given fraction of cells."""
+    from .actor import Plant
+    rng = random.Random(seed)
+    w = World(size=size, metadata={'title': f'Bench {density}'})
+    r = Rect(-size, size, -size, size)
+    for pos in r.coords():
+        if pos != (0, 0) and rng.random() < density:
+            Plant(rng.choice(Plant.PLANTS)).spawn(w, pos)
+    return w
+
+
+def headless_client(world, pos=(0, 0)):
+    """Create a client with no connection, whose PC is in world."""
+    from .actor import PC
+    from .client import Client, ClientSight
+    c = Client(None)
+    c.name = 'bench'
+    c.actor = PC(c)
+    c.actor.spawn(world, pos)
+    c.sight = ClientSight(c.actor)
+    return c
+
+
+def discard_output(c):
+    """Drop the messages a client has queued."""
+    from .client import Client
+    c.pending.clear()
+    Client.dirty.discard(c)
+
+
+for density in DENSITIES:
+    @benchmark(f'query-{density}')
+    def bench_query(density=density):
+        w = populated_world(density)
+
+        def run():
+            for _ in w.query((0, 0), 8):
+                pass
+        return run
+
+
+for density in DENSITIES:
+    @benchmark(f'refresh-{density}')
+    def bench_refresh(density=density):
+        c = headless_client(populated_world(density))
+
+        def run():
+            c.handle_refresh()
+            discard_output(c)
+        return run
+
+
+for subscribers in (1, 100, 1000):
+    @benchmark(f'move-{subscribers}')
+    def bench_move(subscribers=subscribers):
+        from .actor import Scenery
+        w = World(size=40, metadata={'title': 'Bench'})
+        subs = [
+            Subscriber(Rect.from_center((i % 5, 0), 8), w)
+            for i in range(subscribers)
+        ]
+        for s in subs:
+            w.subscribe(s)
+        obj = Scenery('enemies/bat')
+        obj.spawn(w, (0, 0))
+
+        def run():
+            w.move(obj, (1, 0))
+            w.move(obj, (0, 0))
+        run.subs = subs  # the world holds subscribers weakly
+        return run
+
+
+@benchmark('sight-moved')
+def bench_sight_moved():
+    c = headless_client(populated_world(0.5))
+    sight = c.sight
+    pc = c.actor
+
+    def run():
+        sight.moved(pc, (0, 0), (1, 0))
+        sight.moved(pc, (1, 0), (0, 0))
+        discard_output(c)
+    return run
+
+
+def maze_walls():
+    """Get the walls of an enclosure crossed by walls with alternating gaps."""
+    walls = set()
+    for x in range(-1, 34):
+        walls.update([(x, -21), (x, 21)])
+    for y in range(-21, 22):
+        walls.update([(-1, y), (33, y)])
+    for i, x in enumerate(range(4, 33, 4)):
+        gap = 20 if i % 2 else -20
+        walls.update((x, y) for y in range(-20, 21) if y != gap)
+    return walls
+
+
+def open_walls():
+    """Get the walls of the same enclosure with nothing inside it."""
+    return {(x, y) for x, y in maze_walls() if x in (-1, 33) or abs(y) == 21}
+
+
+def walled_world(walls):
+    """Create a world containing the given walls, and its NavGrid."""
+    from .actor import Scenery
+    from .navigation import NavGrid
+    w = World(size=40, metadata={'title': 'Walls'})
+    for pos in walls:
+        Scenery('nature/cliffGrey_block').spawn(w, pos)
+    w.nav = NavGrid.from_cells(walls)
+    return w
+
+
+for layout, walls in (('open', open_walls), ('maze', maze_walls)):
+    @benchmark(f'flowfield-{layout}')
+    def bench_flowfield(walls=walls):
+        from .ai import FlowField
+        w = walled_world(walls())
+        return lambda: FlowField(w, (6, 0))
+
+    @benchmark(f'navgrid-{layout}')
+    def bench_navgrid(walls=walls):
+        w = walled_world(walls())
+        return lambda: w.nav.find_path((0, 0), (30, 0))
+
+
+@benchmark('flowfield-steps')
+def bench_flowfield_steps():
+    from .ai import FlowField
+    w = walled_world(maze_walls())
+    field = FlowField(w, (6, 0))
+    chasers = list(field.dist)
+
+    def run():
+        for pos in chasers:
+            field.next_step(w, pos)
+    return run
+
+
+@benchmark('create-dark-world')
+def bench_create_dark_world():
+    from .world_gen import create_dark_world
+    return lambda: create_dark_world(1)
+
+
+@benchmark('load-heightmap')
+def bench_load_heightmap():
+    from .world_gen import load_heightmap, HEIGHTMAP, LIGHT_WORLD_SIZE
+    from .world_gen import THRESHOLDS
+    return lambda: load_heightmap(HEIGHTMAP, LIGHT_WORLD_SIZE, THRESHOLDS)
+
+
+@benchmark('create-light-world')
+def bench_create_light_world():
+    from .world_gen import create_light_world, generate_terrain
+    terrain = generate_terrain()
+    return lambda: create_light_world(terrain)
+
+
+@benchmark('save-load-world')
+def bench_save_load_world():
+    from . import client, persistence
+    from .world_gen import create_light_world, generate_terrain
+    scratch = tempfile.TemporaryDirectory()
+    savedir, light_world = persistence.savedir, client.light_world
+    persistence.savedir = Path(scratch.name)
+    client.light_world = create_light_world(generate_terrain())
+
+    def run():
+        persistence.save_world()
+        # Load without registering the world, as init_world() would
+        persistence.load_pickle(persistence.world_file)
+
+    def teardown():
+        persistence.savedir, client.light_world = savedir, light_world
+        scratch.cleanup()
+    run.teardown = teardown
+    return run
+
+
+def measure(func, repeat=5):
+    """Time func, returning statistics on the time per call in seconds."""
+    timer = Timer(func)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat, number)]
+    return {
+        'best': min(times),
+        'median': statistics.median(times),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def run(pattern='*', repeat=5, progress=None):
+    """Run the benchmarks with names matching pattern.
+
+    Return the results, in the form saved as a baseline.
+
+    """
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if not fnmatch(name, pattern):
+            continue
+        random.seed(0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            func = setup()
+            try:
+                results[name] = measure(func, repeat)
+            finally:
+                if hasattr(func, 'teardown'):
+                    func.teardown()
+        if progress:
+            progress(name, results[name])
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': results,
+    }
+
+
+def compare(baseline, current, tolerance=TOLERANCE):
+    """Compare two sets of results.
+
+    Return a list of (name, baseline, current, ratio, verdict) for the
+    benchmarks in both, where verdict is 'slower', 'faster' or ''.
+
+    """
+    rows = []
+    for name, base in baseline['benchmarks'].items():
+        cur = current['benchmarks'].get(name)
+        if not cur:
+            continue
+        ratio = cur['best'] / base['best']
+        if ratio > 1 + tolerance:
+            verdict = 'slower'
+        elif ratio < 1 / (1 + tolerance):
+            verdict = 'faster'
+        else:
+            verdict = ''
+        rows.append((name, base['best'], cur['best'], ratio, verdict))
+    return rows
@@ -1,9 +1,9 @@
 import inspect
 import traceback
-import json
 import asyncio
 import weakref
 import re
+from timeit import default_timer
 
 from .coords import Rect, Direction, DIRECTION_MAP, border
 from .world import Collision
@@ -11,13 +11,28 @@ from .actor import PC
 from .items import Inventory
 from .dialog import InventoryDialog
 from .persistence import pickle_atomic, load_pickle
+from . import backends
+from . import metrics
+from .asyncutils import timed
+from .profiler import profiler
+from . import replay
 
 
-loop = asyncio.get_event_loop()
-
 # The world into which clients spawn
 light_world = None
 
+# Valid user names
+NAME_RE = re.compile(r'^[a-z][a-z_0-9]*[a-z]$', flags=re.I)
+
+# Names of the bots connected by loadtest.py
+BOT_NAME_RE = re.compile(r'^bot_[0-9]+_x$')
+
+# Whether to let bots teleport and never save them; see run_server()
+loadtest = False
+
+# Mushrooms that bots start with, to pay for teleporting
+BOT_MUSHROOMS = 1000
+
 
 class ClientSight:
     """Base class for subscribing to world events."""
@@ -42,12 +57,19 @@ class ClientSight:
         self.world.subscribe(self)
 
     def _update_rect(self):
-        self.rect = Rect.from_center(self.actor.pos, self.actor.sight)
+        rect = Rect.from_center(self.actor.pos, self.actor.sight)
+        self.world.reveal(rect)
+        self.rect = rect
 
     def moved(self, obj, from_pos, to_pos):
         if obj is self.actor:
+            # Reveal the new view first, so that anything this creates where
+            # we can already see is sent once as spawned, and anything else
+            # once as coming into sight below
+            rect = Rect.from_center(to_pos, self.actor.sight)
+            self.actor.world.reveal(rect)
             could_see = set(self.actor.world.query(from_pos, self.actor.sight))
-            self._update_rect()
+            self.rect = rect
             now_see = set(self.actor.world.query(to_pos, self.actor.sight))
             for newobj in now_see - could_see:
                 self.spawned(newobj, newobj.pos, 'fade')
@@ -103,21 +125,31 @@ class ClientSight:
 class Client:
     clients = weakref.WeakValueDictionary()
 
+    # Clients with messages to send at the end of the current tick
+    dirty = set()
+
     @classmethod
     def broadcast(cls, msg):
-        encoded = json.dumps(msg)
+        encoded = backends.dumps(msg)
+        op = msg['op']
         for v in cls.clients.values():
+            metrics.messages_sent.inc(op)
+            metrics.bytes_sent.inc(op, amount=len(encoded))
             v._write(encoded)
 
     def __init__(self, ws):
         self.name = None
         self.outqueue = asyncio.Queue()
+        self.pending = []
         self.ws = ws
         self._gold = 0  # TODO: load from storage
         self.actor = None
         self.dialog = None
         self.caps = set()
 
+        # The world in another process that the player is in, if any
+        self.remote = None
+
     def can(self, capability):
         """Return True if the player has a capability."""
         return capability in self.caps
@@ -142,26 +174,68 @@ class Client:
 
     def write(self, msg):
         """Write a message to the client."""
-        self._write(json.dumps(msg))
+        encoded = backends.dumps(msg)
+        op = msg['op']
+        metrics.messages_sent.inc(op)
+        metrics.bytes_sent.inc(op, amount=len(encoded))
+        self._write(encoded)
 
     def _write(self, msg):
-        self.outqueue.put_nowait(msg)
+        self.pending.append(msg)
+        Client.dirty.add(self)
+
+    def pop_frame(self):
+        """Take all pending messages as one frame, or None if there are none."""
+        pending = self.pending
+        if not pending:
+            return None
+        self.pending = []
+        if len(pending) == 1:
+            return pending[0]
+        return '{"op": "batch", "msgs": [' + ', '.join(pending) + ']}'
+
+    def flush(self):
+        """Send all pending messages to the client as one frame."""
+        frame = self.pop_frame()
+        if frame:
+            self.outqueue.put_nowait(frame)
+
+    @classmethod
+    def flush_all(cls):
+        """Flush all clients that have pending messages."""
+        dirty = cls.dirty
+        cls.dirty = set()
+        for c in dirty:
+            c.flush()
 
     def close(self):
         if not self.name:
             return
         print(f"{self.name} disconnected")
+        Client.dirty.discard(self)
+        self.flush()
         self.outqueue.put_nowait(None)
         Client.broadcast({
             'op': 'announce',
             'msg': f"{self.name} disconnected"
         })
         self.clients.pop(self.name, None)
+        if self.remote:
+            # The player is saved when the worker hands them back
+            self.remote.disconnect(self)
+            return
         if self.actor:
             self.actor.kill(effect='disconnect')
         self.save()
 
+    @property
+    def is_bot(self):
+        """Return True if this is a load test bot, while load testing."""
+        return loadtest and bool(BOT_NAME_RE.match(self.name or ''))
+
     def save(self):
+        if self.is_bot:
+            return
         pickle_atomic(self.user_file(self.name), self.get_user_data())
         pickle_atomic(self.inventory_file, self.inventory)
 
@@ -194,6 +268,20 @@ class Client:
     def user_file(self, name):
         return f'{name}-user.pck'
 
+    def get_state(self):
+        """Get everything needed to take the player to another process."""
+        return {
+            'name': self.name,
+            'inventory': self.inventory,
+            **self.get_user_data(),
+        }
+
+    def set_state(self, state):
+        """Update the player from the state sent back by another process."""
+        self.inventory = state['inventory']
+        self.caps = state['caps']
+        self.gold = state['gold']
+
     def get_user_data(self):
         if self.actor:
             health = self.actor.health
@@ -218,21 +306,29 @@ class Client:
                 'reason': 'You are already authenticated'
             })
 
-        if not re.match(r'^[a-z][a-z_0-9]*[a-z]$', name, flags=re.I):
+        if not NAME_RE.match(name):
             return self.write({
                 'op': 'authfail',
                 'reason': 'Invalid name; please use only lowercase letters ' +
                           'and numbers'
             })
-        data = self.load_user_data(name) or {}
-        if data:
+        if loadtest and BOT_NAME_RE.match(name):
+            # Bots start afresh every time
+            data = {'caps': {'teleport'}}
+        else:
+            data = self.load_user_data(name) or {}
+        if data.get('token'):
             if token != data['token']:
                 return self.write({
                     'op': 'authfail',
                     'reason': 'Invalid authentication token',
                 })
 
-        if name in self.clients:
+        from .instances import worlds
+        if name in self.clients or (
+                worlds.shards and name in worlds.shards.sessions):
+            # A player who disconnected while in a worker keeps their name
+            # until the worker hands them back and they have been saved
             return self.write({
                 'op': 'authfail',
                 'reason': 'You are already connected',
@@ -247,7 +343,11 @@ class Client:
             'msg': f"{name} connected"
         })
         self.write({'op': 'authok'})
-        self.inventory = load_pickle(self.inventory_file) or Inventory()
+        if self.is_bot:
+            self.inventory = Inventory()
+            self.inventory.add('mushroom', BOT_MUSHROOMS)
+        else:
+            self.inventory = load_pickle(self.inventory_file) or Inventory()
         self.gold = data.get('gold') or 0
         self.caps = data.get('caps') or set()
         self.respawn(health=data.get('health') or 0)
@@ -311,6 +411,7 @@ class Client:
 
     def handle_refresh(self):
         center = self.actor.pos
+        self.actor.world.reveal(Rect.from_center(center, self.actor.sight))
         objs = []
         for obj in self.actor.world.query(center, self.actor.sight):
             objs.append(obj.to_json())
@@ -335,6 +436,20 @@ class Client:
     def handle_inventory(self):
         self.show_dialog(InventoryDialog(self.inventory))
 
+    def handle_profile(self, seconds=10):
+        """Run the sampling profiler over the server for a while."""
+        if not self.can('developer'):
+            self.text_message('You are not allowed to do that.')
+            return
+
+        def done(path, summary):
+            self.text_message(f'Profile written to {path.name}: {summary}')
+
+        if profiler.start(float(seconds), done):
+            self.text_message(f'Profiling for {seconds} seconds...')
+        else:
+            self.text_message('A profile is already running.')
+
     def show_dialog(self, dlg):
         self.dialog = dlg
         self.write({
@@ -357,31 +472,61 @@ class Client:
             await self.ws.send_str(msg)
 
     async def receiver(self):
+        if replay.recorder:
+            replay.recorder.connected(self)
         try:
             async for m in self.ws:
                 await asyncio.sleep(0.1)
-                msg = m.json()
-                op = msg.pop('op')
-                if not self.name and op != 'auth':
-                    self.write({
-                        'op': 'error',
-                        'msg': 'You are not authenticated'
-                    })
-                    continue
-                if op != 'dlgresponse' and self.dialog:
-                    self.dialog = None
-                    self.write({'op': 'canceldialog'})
-                try:
-                    handler = getattr(self, f'handle_{op}')
-                    if inspect.iscoroutinefunction(handler):
-                        await handler(**msg)
-                    else:
-                        handler(**msg)
-                except Exception as e:
-                    traceback.print_exc()
-                    self.write({
-                        'op': 'error',
-                        'msg': f'{type(e).__name__}: {e}',
-                    })
+                msg = m.json(loads=backends.loads)
+                await self.handle_message(msg, len(m.data))
         finally:
+            if replay.recorder:
+                replay.recorder.closed(self)
             self.close()
+
+    async def handle_message(self, msg, size=0):
+        """Handle a decoded message from the client."""
+        op = msg.pop('op')
+        known = op if hasattr(self, f'handle_{op}') else 'unknown'
+        metrics.messages_received.inc(known)
+        metrics.bytes_received.inc(known, amount=size)
+        if replay.recorder:
+            replay.recorder.received(self, op, msg)
+        if not self.name and op != 'auth':
+            self.write({
+                'op': 'error',
+                'msg': 'You are not authenticated'
+            })
+            return
+        if self.remote:
+            self.remote.send_op(self, op, msg)
+            return
+        if op != 'dlgresponse' and self.dialog:
+            self.dialog = None
+            self.write({'op': 'canceldialog'})
+        await self.dispatch(op, msg)
+
+    async def dispatch(self, op, msg):
+        """Call the handler for an op, recording how long it takes."""
+        world = self.actor and self.actor.world
+        context = {
+            'user': self.name,
+            'world': world and world.metadata.get('title'),
+        }
+        try:
+            handler = getattr(self, f'handle_{op}')
+            if inspect.iscoroutinefunction(handler):
+                await timed(handler(**msg), 'op', op, **context)
+            else:
+                start = default_timer()
+                try:
+                    handler(**msg)
+                finally:
+                    elapsed = default_timer() - start
+                    metrics.record('op', op, elapsed, **context)
+        except Exception as e:
+            traceback.print_exc()
+            self.write({
+                'op': 'error',
+                'msg': f'{type(e).__name__}: {e}',
+            })
@@ -60,11 +60,13 @@ def random_dir():
     return random.choice(ALL_DIRECTIONS)
 
 
+NEIGHBOUR_DELTAS = [DIRECTION_MAP[d] for d in Direction]
+
+
 def neighbours(pos):
     """Get all neighbours of a position."""
     x, y = pos
-    for d in Direction:
-        dx, dy = DIRECTION_MAP[d]
+    for dx, dy in NEIGHBOUR_DELTAS:
         yield x + dx, y + dy
 
 
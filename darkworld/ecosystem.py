@@ -1,74 +1,163 @@
-"""The ecosystem of plants and things."""
-import asyncio
+"""The ecosystem of plants and things.
+
+Foliage grows lazily. The light world's foliage area is divided into chunks,
+each recording when it was last simulated; growth in a chunk is only worked
+out when someone can see it, in one batch covering all the time since. Each
+kind of foliage has a density cap per chunk, so unwatched parts of the map
+settle to a steady state instead of filling up.
+
+"""
+import math
 import random
+from timeit import default_timer
 
 from .coords import random_dir
-from .world import Collision
-from .actor import Mushroom, Tree, Bush, Plant
+from .world import Subscriber
+from .actor import Mushroom, Tree
+from .ai import All
 from . import client
 from .persistence import save_world
+from .scheduler import ticker
+from .world_gen import CHUNK_SIZE
+from .instances import dark_worlds, worlds
+from . import metrics
+from .watchdog import watchdog
+from .memory import monitor
+
+
+# Seconds of growth to accumulate in a chunk before simulating it again
+GROWTH_INTERVAL = 15
+
+# For each kind of foliage, the number that grow per second across the whole
+# foliage area, and the most there can be per foliage cell.
+# No way of clearing bushes or plants yet, so they don't grow.
+GROWTH = {
+    Mushroom: (1 / 15, 0.04),
+    Tree: (0.05 / 15, 0.03),
+}
+
+
+class FoliageChunk:
+    """The foliage cells in one chunk and the foliage growing on them."""
+
+    def __init__(self, now):
+        self.cells = []
+        self.last = now
+        self.counts = dict.fromkeys(GROWTH, 0)
+
+
+class Foliage(Subscriber):
+    """Grow foliage in a world a chunk at a time, when it is seen.
+
+    This is installed as the world's `chunks`, so that World.reveal() brings
+    growth up to date, and subscribes to the world to keep counts of the
+    foliage in each chunk.
+
+    """
+    def __init__(self, world):
+        super().__init__(All(), world)
+        now = ticker.time
+        self.total = len(world.foliage_area)
+        self.chunks = {}
+        for pos in world.foliage_area:
+            key = pos[0] // CHUNK_SIZE, pos[1] // CHUNK_SIZE
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                chunk = self.chunks[key] = FoliageChunk(now)
+            chunk.cells.append(pos)
+
+        for pos, obj in world.grid.items():
+            while obj:
+                self._count(obj, pos, 1)
+                obj = obj.below
+
+    def _count(self, obj, pos, n):
+        kind = type(obj)
+        if kind in GROWTH:
+            key = pos[0] // CHUNK_SIZE, pos[1] // CHUNK_SIZE
+            chunk = self.chunks.get(key)
+            if chunk:
+                chunk.counts[kind] += n
+
+    def spawned(self, obj, pos, effect):
+        self._count(obj, pos, 1)
+
+    def killed(self, obj, pos, effect):
+        self._count(obj, pos, -1)
+
+    def reveal(self, world, rect):
+        """Catch up growth in the chunks overlapping rect."""
+        now = ticker.time
+        for cx in range(rect.x1 // CHUNK_SIZE, rect.x2 // CHUNK_SIZE + 1):
+            for cy in range(rect.y1 // CHUNK_SIZE, rect.y2 // CHUNK_SIZE + 1):
+                chunk = self.chunks.get((cx, cy))
+                if chunk and now - chunk.last >= GROWTH_INTERVAL:
+                    self.grow(world, chunk, now)
+
+    def reveal_pos(self, world, pos):
+        """Nothing to do; growth only needs to be seen, not walked into."""
+
+    def grow(self, world, chunk, now):
+        """Grow the foliage expected in a chunk since it was last simulated."""
+        elapsed = now - chunk.last
+        chunk.last = now
+        share = len(chunk.cells) / self.total
+        for kind, (rate, density) in GROWTH.items():
+            room = math.ceil(len(chunk.cells) * density) - chunk.counts[kind]
+            num = min(int(rate * share * elapsed + random.random()), room)
+            if num <= 0:
+                continue
+            free = [p for p in chunk.cells if p not in world.grid]
+            for pos in random.sample(free, min(num, len(free))):
+                kind.random().spawn(
+                    world,
+                    pos=pos,
+                    direction=random_dir(),
+                    effect='grow'
+                )
 
 
 def tick():
-    spawn_foliage(Mushroom.random())
-    # No way of clearing bushes or plants yet
-    # spawn_foliage(Plant.random())
-#    if random.random() < 0.3:
-#        spawn_foliage(Bush.random())
-    if random.random() < 0.05:
-        spawn_foliage(Tree.random())
-
-
-def spawn_foliage(actor):
-    for _ in range(5):
-        pos = random.choice(client.light_world.foliage_area)
-        if pos in client.light_world.grid:
-            continue
-        try:
-            actor.spawn(
-                client.light_world,
-                pos=pos,
-                direction=random_dir(),
-                effect='grow'
-            )
-        except Collision:
-            continue
-        else:
-            #print(f'Spawned {type(actor).__name__} at {pos}')
-            return
-
-
-async def run_ecosystem():
-    try:
-        while True:
-            if client.Client.clients:
-                tick()
-            await asyncio.sleep(15)
-    except asyncio.CancelledError:
-        return
-
-
-tasks = []
-
-
-async def autosave():
-    """Save the whole world every 5 minutes."""
-    try:
-        while True:
-            await asyncio.sleep(300)
-            save_world()
-            client.Client.save_all()
-    except asyncio.CancelledError:
-        return
+    """Grow foliage in the chunks that players are looking at."""
+    world = client.light_world
+    for c in client.Client.clients.values():
+        if c.actor and c.actor.world is world:
+            world.reveal(c.sight.rect)
+
+
+def autosave():
+    """Save the whole world."""
+    start = default_timer()
+    size = save_world()
+    client.Client.save_all()
+    metrics.autosave_seconds.observe(default_timer() - start)
+    metrics.autosave_bytes.set(value=size)
+
+
+def setup_systems():
+    """Add the systems that simulate the worlds, without starting them."""
+    client.light_world.chunks = Foliage(client.light_world)
+    client.light_world.subscribe(client.light_world.chunks)
+    client.light_world.scheduler.add_system(
+        tick,
+        GROWTH_INTERVAL,
+        name='ecosystem'
+    )
+    ticker.main.add_system(autosave, 300, name='autosave')
+    ticker.at_end_of_tick(client.Client.flush_all)
+    worlds.start()
 
 
 def start_processes():
-    tasks.extend([
-        asyncio.ensure_future(run_ecosystem()),
-        asyncio.ensure_future(autosave())
-    ])
+    """Start simulating the worlds in real time."""
+    setup_systems()
+    ticker.start()
+    dark_worlds.start()
+    watchdog.start()
+    monitor.start()
 
 
 def stop_processes():
-    for task in tasks:
-        task.cancel()
+    ticker.stop()
+    dark_worlds.stop()
+    watchdog.stop()
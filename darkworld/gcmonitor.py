@@ -0,0 +1,94 @@
+"""Keep garbage collection pauses short, and make them visible.
+
+The light world is tens of thousands of long-lived objects, which every
+full collection would otherwise rescan. Once it is loaded, freeze() moves
+everything allocated so far out of the collector's reach; frozen objects
+are still freed by reference counting when they are deleted.
+
+Collection thresholds can be set with DARKWORLD_GC_THRESHOLD, as up to
+three comma-separated numbers as for gc.set_threshold(). The time taken
+by each collection is recorded per generation, and long pauses are logged
+like slow handlers.
+
+"""
+import gc
+import os
+from timeit import default_timer
+
+from . import metrics
+
+
+# Collection thresholds, if not Python's defaults
+THRESHOLD = os.environ.get('DARKWORLD_GC_THRESHOLD')
+
+
+pause_seconds = metrics.Histogram(
+    'darkworld_gc_pause_seconds',
+    'Time taken by garbage collections of each generation.',
+    ('generation',),
+    metrics.LATENCY_BUCKETS
+)
+collected = metrics.Counter(
+    'darkworld_gc_collected_total',
+    'Objects freed by garbage collections of each generation.',
+    ('generation',)
+)
+metrics.Gauge(
+    'darkworld_gc_frozen_objects',
+    'Objects moved out of reach of the garbage collector.',
+    func=gc.get_freeze_count
+)
+
+
+class GCMonitor:
+    """Time garbage collections, through gc.callbacks."""
+
+    def __init__(self):
+        self.started = None
+
+    def install(self):
+        if self.callback not in gc.callbacks:
+            gc.callbacks.append(self.callback)
+
+    def uninstall(self):
+        if self.callback in gc.callbacks:
+            gc.callbacks.remove(self.callback)
+
+    def callback(self, phase, info):
+        if phase == 'start':
+            self.started = default_timer()
+            return
+        if self.started is None:
+            return
+        elapsed = default_timer() - self.started
+        self.started = None
+        generation = str(info['generation'])
+        pause_seconds.observe(elapsed, generation)
+        collected.inc(generation, amount=info['collected'])
+        if elapsed > metrics.SLOW_THRESHOLD:
+            metrics.log_slow(
+                'gc', f'gen{generation}', elapsed,
+                collected=info['collected']
+            )
+
+
+monitor = GCMonitor()
+
+
+def configure(threshold=THRESHOLD):
+    """Set the collection thresholds and start timing collections."""
+    if threshold:
+        gc.set_threshold(*(int(v) for v in threshold.split(',')))
+    monitor.install()
+
+
+def freeze():
+    """Move everything allocated so far out of the collector's reach.
+
+    Call this once long-lived state has been loaded and before players
+    connect. Garbage is collected first, so that it is not frozen too.
+
+    """
+    gc.collect()
+    gc.freeze()
+    print(f'Froze {gc.get_freeze_count()} objects out of collection')
@@ -0,0 +1,349 @@
+"""Supply and manage dark world instances.
+
+Generating a dark world's layout - random walks, erosion, walls and
+navigation data - runs in a worker process from a seed. Back on the event
+loop only the actors are created from the layout. A few instances are kept
+ready so that activating a teleporter can hand one out immediately.
+
+The WorldManager registers every world, counts the players in each, and tears
+down dark worlds once they are empty.
+
+"""
+import asyncio
+import itertools
+import random
+import traceback
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer
+
+from .world import Subscriber
+from .actor import PC
+from .ai import All
+from .scheduler import ticker
+from .world_gen import generate_dark_layout, build_dark_world, create_dark_world
+from .memory import world_memory, REPORT_INTERVAL
+from . import metrics
+from . import replay
+
+
+# Number of dark worlds to keep ready
+POOL_SIZE = 2
+
+
+def timed_layout(seed):
+    """Generate a dark layout, returning it with the time taken.
+
+    This runs in the worker process, where metrics are not collected.
+
+    """
+    start = default_timer()
+    layout = generate_dark_layout(seed)
+    return layout, default_timer() - start
+
+
+class DarkWorldPool:
+    """A pool of pre-generated dark worlds, refilled in the background."""
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.ready = deque()
+        self.pending = 0
+        self.executor = None
+        self.rng = random.Random()
+
+        # Seeds to use for the next worlds, as when replaying a recording
+        self.seeds = deque()
+
+    def start(self):
+        """Start the worker process and fill the pool."""
+        self.executor = ProcessPoolExecutor(max_workers=1)
+        self.refill()
+
+    def stop(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def refill(self):
+        """Request new layouts until the pool will be full."""
+        if not self.executor:
+            return
+        loop = asyncio.get_event_loop()
+        while len(self.ready) + self.pending < self.size:
+            self.pending += 1
+            seed = self.rng.getrandbits(32)
+            fut = loop.run_in_executor(
+                self.executor,
+                timed_layout,
+                seed
+            )
+            fut.add_done_callback(self._on_generated)
+
+    def _on_generated(self, fut):
+        self.pending -= 1
+        if fut.cancelled():
+            return
+        try:
+            layout, elapsed = fut.result()
+        except Exception:
+            traceback.print_exc()
+            return
+        metrics.worldgen_seconds.observe(elapsed, 'layout')
+        start = default_timer()
+        self.ready.append(build_dark_world(layout))
+        metrics.worldgen_seconds.observe(default_timer() - start, 'build')
+
+    def get(self):
+        """Get a new dark world.
+
+        If none is ready, one is generated on the spot. Worlds are generated
+        from `seeds` first, if any have been given.
+
+        """
+        if self.seeds:
+            world = create_dark_world(self.seeds.popleft())
+        elif self.ready:
+            world = self.ready.popleft()
+        else:
+            world = create_dark_world()
+        self.refill()
+        return world
+
+
+dark_worlds = DarkWorldPool()
+
+
+# Players allowed in one dark world instance
+INSTANCE_CAPACITY = 4
+
+# Live dark world instances allowed before players are sent to existing ones
+MAX_INSTANCES = 50
+
+# Estimated bytes of live world state allowed before doing the same
+MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Seconds allowed for players to arrive in an instance reserved for them
+ARRIVAL_TIMEOUT = 30
+
+
+class Instance(Subscriber):
+    """A world registered with the WorldManager.
+
+    This subscribes to the whole world to count the PCs in it.
+
+    """
+    def __init__(self, manager, world, name, persistent):
+        super().__init__(All(), world)
+        self.manager = manager
+        self.ref = weakref.ref(world)
+        self.name = name
+        self.persistent = persistent
+        self.population = 0
+        self.arriving = 0
+        self.reserved_at = None
+        self.released_at = None
+        self.size = 0
+        self.measured_at = None
+
+    def __repr__(self):
+        return f'<Instance {self.name} population {self.population}>'
+
+    @property
+    def world(self):
+        return self.ref()
+
+    @property
+    def room(self):
+        """The number of players who can still join this instance."""
+        return INSTANCE_CAPACITY - self.population - self.arriving
+
+    def memory(self):
+        """Estimate the bytes used by the world."""
+        world = self.ref()
+        if not world:
+            return 0
+        # Measuring takes milliseconds, so reuse recent measurements
+        if self.measured_at is None or \
+                ticker.time - self.measured_at >= REPORT_INTERVAL:
+            parts, classes = world_memory(world)
+            self.size = sum(parts.values())
+            self.measured_at = ticker.time
+        return self.size
+
+    def reserve(self, players):
+        """Hold room for players who are on their way."""
+        self.arriving += players
+        self.reserved_at = ticker.time
+
+    def spawned(self, obj, pos, effect):
+        if isinstance(obj, PC):
+            self.population += 1
+            if self.arriving:
+                self.arriving -= 1
+
+    def killed(self, obj, pos, effect):
+        if isinstance(obj, PC):
+            self.population -= 1
+            if not self.population and not self.arriving:
+                self.manager.release(self)
+
+
+class WorldManager:
+    """Keep track of every world and the lifecycle of dark world instances.
+
+    Dark worlds are torn down as soon as the last player leaves, and checked
+    later to make sure that they were actually freed. New instances are only
+    created while within `max_instances` and `memory_budget`; beyond those,
+    players join existing instances that have room.
+
+    """
+    def __init__(
+            self,
+            max_instances=MAX_INSTANCES,
+            memory_budget=MEMORY_BUDGET):
+        self.max_instances = max_instances
+        self.memory_budget = memory_budget
+        self.instances = {}
+        self.released = []
+        self.seq = itertools.count(1)
+        self.created = 0
+        self.torn_down = 0
+        self.freed = 0
+
+        # Worker processes to run dark worlds in, if any
+        self.shards = None
+
+    def start(self):
+        ticker.main.add_system(self.sweep, ARRIVAL_TIMEOUT, name='instances')
+
+    def register(self, world, name=None, persistent=False):
+        """Start tracking a world.
+
+        Persistent worlds, like the light world, are never torn down.
+
+        """
+        name = name or f'dark-{next(self.seq)}'
+        inst = Instance(self, world, name, persistent)
+        world.subscribe(inst)
+        if replay.recorder and not persistent:
+            replay.recorder.world_created(world)
+        self.instances[name] = inst
+        self.created += 1
+        weakref.finalize(world, self._on_freed, name)
+        return inst
+
+    def _on_freed(self, name):
+        self.freed += 1
+        self.instances.pop(name, None)
+
+    def dark_instances(self):
+        """Get the live dark world instances."""
+        return [
+            inst for inst in self.instances.values()
+            if not inst.persistent and not inst.released_at
+        ]
+
+    def memory(self):
+        """Estimate the bytes used by all worlds."""
+        return sum(inst.memory() for inst in self.instances.values())
+
+    def over_limit(self):
+        """Return True if no more instances should be created."""
+        return (
+            len(self.dark_instances()) >= self.max_instances
+            or self.memory() >= self.memory_budget
+        )
+
+    def get_dark_world(self, players=1):
+        """Get a dark world for a group of players to teleport to.
+
+        Return None if we are over the limits and no instance has room.
+
+        """
+        if self.shards:
+            return self.shards.get_dark_world(players)
+        if self.over_limit():
+            candidates = [
+                inst for inst in self.dark_instances()
+                if inst.room >= players and inst.world
+            ]
+            if not candidates:
+                return None
+            # Fill up the busiest instances first
+            inst = max(candidates, key=lambda i: i.population + i.arriving)
+            world = inst.world
+        else:
+            world = dark_worlds.get()
+            inst = self.register(world)
+        inst.reserve(players)
+        return world
+
+    def release(self, inst):
+        """Tear down an instance at the next tick, if it is still empty."""
+        if not inst.persistent:
+            ticker.main.call_later(0, self.teardown, inst)
+
+    def teardown(self, inst):
+        """Tear down an empty instance.
+
+        This breaks the references within the world - its systems, timers,
+        subscribers and actors - so that it is freed as soon as the last PC
+        lets go of it, rather than whenever the garbage collector gets
+        around to it.
+
+        """
+        if inst.persistent or inst.released_at:
+            return
+        if inst.population or inst.arriving:
+            return
+        world = inst.world
+        inst.released_at = ticker.time
+        self.torn_down += 1
+        if not world:
+            return
+        world.scheduler.systems.clear()
+        world.scheduler.timers.clear()
+        world.subscriptions = weakref.WeakSet()
+        world.chunks = None
+        world.ai = None
+        world.grid.clear()
+        world.by_uid.clear()
+        self.released.append(inst)
+
+    def sweep(self):
+        """Expire stale reservations and report worlds that were not freed.
+
+        Dead PCs hold on to their world until they respawn, so a world is
+        only reported once it has stayed unfreed for a while.
+
+        """
+        now = ticker.time
+        for inst in self.dark_instances():
+            if inst.arriving and now - inst.reserved_at > ARRIVAL_TIMEOUT:
+                inst.arriving = 0
+                self.teardown(inst)
+
+        unfreed = [inst for inst in self.released if inst.world]
+        for inst in unfreed:
+            if now - inst.released_at > ARRIVAL_TIMEOUT:
+                print(f'{inst.name} was torn down but has not been freed')
+        self.released = unfreed
+
+    def stats(self):
+        """Get a summary of the worlds and their lifecycle."""
+        return {
+            'instances': len(self.dark_instances()),
+            'population': sum(
+                inst.population for inst in self.instances.values()
+            ),
+            'memory': self.memory(),
+            'created': self.created,
+            'torn_down': self.torn_down,
+            'freed': self.freed,
+            'unfreed': sum(1 for inst in self.released if inst.world),
+        }
+
+
+worlds = WorldManager()
@@ -36,10 +36,10 @@ class Unique(Stackable):
         return id(self)
 
 
-def generate_loot():
+def generate_loot(rng=random):
     """Generate a random piece of loot."""
     from .actor import Collectable
-    item = random.choice(COLLECTABLES)
+    item = rng.choice(COLLECTABLES)
     return Collectable(item)
 
 
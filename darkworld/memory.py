@@ -0,0 +1,268 @@
+"""Account for the memory used by worlds, actors and clients.
+
+Sizes are estimated by walking object graphs with sys.getsizeof(). Large
+containers are sampled rather than walked in full, and actors are sized
+from a sample of each class, so a full report costs a few milliseconds
+even for the light world. The figures are estimates of the Python objects
+involved, and are reported next to the process's resident size so that
+the unaccounted remainder is visible too.
+
+"""
+import enum
+import random
+import sys
+import types
+import weakref
+from collections import Counter, defaultdict, deque
+
+from .world import World
+from .actor import Actor
+from .scheduler import ticker
+from . import metrics
+
+
+# Containers with more items than this are sized from a sample
+SAMPLE_SIZE = 50
+
+# Seconds between updates of the memory gauges
+REPORT_INTERVAL = 60
+
+# Objects never counted as part of something else
+NOT_OWNED = (
+    type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+    types.MethodType, weakref.ref, weakref.WeakSet, enum.Enum,
+)
+
+
+def _sample(items):
+    """Return a sample of items and the factor to scale its size by."""
+    n = len(items)
+    if n <= SAMPLE_SIZE:
+        return list(items), 1
+    if not isinstance(items, (list, tuple)):
+        items = list(items)
+    return random.sample(items, SAMPLE_SIZE), n / SAMPLE_SIZE
+
+
+def sizeof(obj, stop=(), seen=None):
+    """Estimate the bytes used by obj and the objects it owns.
+
+    Instances of the types in `stop`, other than obj itself, are treated as
+    belonging to something else and are not counted.
+
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, NOT_OWNED):
+        return 0
+    if obj is not None and stop and isinstance(obj, stop) and seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        items, scale = _sample(list(obj.items()))
+        size += scale * sum(
+            sizeof(k, stop, seen) + sizeof(v, stop, seen) for k, v in items
+        )
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        items, scale = _sample(obj)
+        size += scale * sum(sizeof(v, stop, seen) for v in items)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, NOT_OWNED):
+        size += sizeof(vars(obj), stop, seen)
+    return int(size)
+
+
+def rss():
+    """Get the resident set size of the process, in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        import resource
+        # Peak rather than current, but the best we can do here
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    import os
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def actor_classes(world):
+    """Get the count and estimated bytes of each class of actor in world."""
+    by_class = defaultdict(list)
+    for obj in world.by_uid.values():
+        by_class[type(obj).__name__].append(obj)
+
+    result = {}
+    from .client import Client
+    stop = (Actor, World, Client)
+    for name, actors in by_class.items():
+        sample, scale = _sample(actors)
+        size = scale * sum(sizeof(a, stop) for a in sample)
+        result[name] = (len(actors), int(size))
+    return result
+
+
+def world_memory(world):
+    """Estimate the memory used by each part of a world."""
+    stop = (Actor, World)
+    keys, scale = _sample(list(world.grid))
+    classes = actor_classes(world)
+    return {
+        'grid': sys.getsizeof(world.grid) + int(
+            scale * sum(sizeof(k) for k in keys)
+        ),
+        'by_uid': sys.getsizeof(world.by_uid),
+        'actors': sum(size for n, size in classes.values()),
+        'terrain': (
+            sizeof(world.accessible_area) + sizeof(world.foliage_area)
+        ),
+        'ai': sizeof(getattr(world, 'ai', None), stop),
+        'nav': sizeof(world.nav),
+        'chunks': sizeof(world.chunks, stop),
+    }, classes
+
+
+def client_memory(client):
+    """Estimate the memory used by a client."""
+    from .client import Client
+    stop = (Actor, World, Client)
+    return {
+        'outqueue': sizeof(client.outqueue._queue),
+        'pending': sizeof(client.pending),
+        'inventory': sizeof(getattr(client, 'inventory', None)),
+        'sight': sizeof(getattr(client, 'sight', None), stop),
+    }
+
+
+def live_worlds():
+    """Iterate over (name, world) for every world we know about."""
+    from .instances import worlds, dark_worlds
+    for name, inst in list(worlds.instances.items()):
+        world = inst.world
+        if world:
+            yield name, world
+    for i, world in enumerate(dark_worlds.ready):
+        yield f'ready-{i}', world
+
+
+class MemoryReport:
+    """A breakdown of the memory used by the server."""
+
+    def __init__(self):
+        from .client import Client
+
+        self.time = ticker.time
+        self.rss = rss()
+        self.worlds = {}
+        self.classes = Counter()
+        self.class_bytes = Counter()
+        for name, world in live_worlds():
+            parts, classes = world_memory(world)
+            self.worlds[name] = parts
+            for cls, (n, size) in classes.items():
+                self.classes[cls] += n
+                self.class_bytes[cls] += size
+
+        self.clients = {
+            name: client_memory(c)
+            for name, c in list(Client.clients.items())
+        }
+
+    @property
+    def accounted(self):
+        return (
+            sum(sum(p.values()) for p in self.worlds.values())
+            + sum(sum(p.values()) for p in self.clients.values())
+        )
+
+    def format(self):
+        """Format the report as text."""
+        mb = 1024 * 1024
+        lines = [
+            f'Resident size: {self.rss / mb:.1f}MB, '
+            f'of which {self.accounted / mb:.1f}MB is accounted for below',
+            '',
+            'Worlds:',
+        ]
+        for name, parts in self.worlds.items():
+            total = sum(parts.values())
+            detail = ', '.join(
+                f'{part} {size / 1024:.0f}K' for part, size in parts.items()
+            )
+            lines.append(f'  {name}: {total / mb:.2f}MB ({detail})')
+
+        lines += ['', 'Actors by class:']
+        for cls, size in self.class_bytes.most_common():
+            lines.append(
+                f'  {cls}: {self.classes[cls]} using {size / 1024:.0f}K'
+            )
+
+        lines += ['', 'Clients:']
+        for name, parts in self.clients.items():
+            detail = ', '.join(
+                f'{part} {size / 1024:.1f}K' for part, size in parts.items()
+            )
+            lines.append(f'  {name}: {detail}')
+        return '\n'.join(lines)
+
+
+class MemoryMonitor:
+    """Keep a recent memory report for the metrics gauges."""
+
+    def __init__(self):
+        self.last = None
+
+    def start(self):
+        self.update()
+        ticker.main.add_system(self.update, REPORT_INTERVAL, name='memory')
+
+    def update(self):
+        self.last = MemoryReport()
+
+    def _gauge(self, func):
+        def get():
+            return func(self.last) if self.last else {}
+        return get
+
+
+monitor = MemoryMonitor()
+
+metrics.Gauge(
+    'darkworld_memory_rss_bytes',
+    'Resident size of the server process.',
+    func=rss
+)
+metrics.Gauge(
+    'darkworld_world_memory_bytes',
+    'Estimated memory used by each part of each world.',
+    ('world', 'part'),
+    func=monitor._gauge(lambda r: {
+        (name, part): size
+        for name, parts in r.worlds.items()
+        for part, size in parts.items()
+    })
+)
+metrics.Gauge(
+    'darkworld_actor_count',
+    'Actors of each class in all worlds.',
+    ('class',),
+    func=monitor._gauge(lambda r: {(c,): n for c, n in r.classes.items()})
+)
+metrics.Gauge(
+    'darkworld_actor_memory_bytes',
+    'Estimated memory used by actors of each class in all worlds.',
+    ('class',),
+    func=monitor._gauge(
+        lambda r: {(c,): n for c, n in r.class_bytes.items()}
+    )
+)
+metrics.Gauge(
+    'darkworld_client_memory_bytes',
+    'Estimated memory used by each part of each client.',
+    ('client', 'part'),
+    func=monitor._gauge(lambda r: {
+        (name, part): size
+        for name, parts in r.clients.items()
+        for part, size in parts.items()
+    })
+)
@@ -0,0 +1,331 @@
+"""Metrics about the running server, in Prometheus text format.
+
+Counters and histograms are plain dicts keyed by label values, so updating
+one costs about as much as a dict lookup. Gauges that describe the state of
+the server - clients, worlds and so on - are computed from that state when
+the metrics are scraped, rather than being kept up to date all the time.
+
+"""
+import math
+import os
+from bisect import bisect_left
+from collections import defaultdict
+
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+# Buckets for handlers, which mostly take well under a millisecond
+LATENCY_BUCKETS = (0.00001, 0.0001, 0.00025, 0.0005) + DEFAULT_BUCKETS
+
+# Seconds a handler may hold the event loop before it is logged as slow
+SLOW_THRESHOLD = float(os.environ.get('DARKWORLD_SLOW_THRESHOLD', 0.05))
+
+registry = []
+
+
+def escape(value):
+    """Escape a label value."""
+    return (
+        str(value)
+        .replace('\\', r'\\')
+        .replace('"', r'\"')
+        .replace('\n', r'\n')
+    )
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """Base class for metrics."""
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry.append(self)
+
+    def samples(self):
+        """Iterate over (name, label values, extra labels, value)."""
+        return ()
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        for name, values, extra, value in self.samples():
+            labels = format_labels(self.labels, values, extra)
+            yield f'{name}{labels} {value}'
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = defaultdict(int)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] += amount
+
+    def since(self, before):
+        """Get the increase in each value since `before`, a copy of values.
+
+        Keys are the label values joined with commas.
+
+        """
+        return {
+            ','.join(labels): value - before.get(labels, 0)
+            for labels, value in sorted(self.values.items())
+            if value != before.get(labels, 0)
+        }
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, labels, '', value
+
+
+class Gauge(Metric):
+    """A value that goes up and down.
+
+    If `func` is given it is called on each scrape, and should return a
+    dict mapping tuples of label values to values, or a single value if
+    there are no labels.
+
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), func=None):
+        super().__init__(name, help, labels)
+        self.values = {}
+        self.func = func
+
+    def set(self, *labels, value):
+        self.values[labels] = value
+
+    def samples(self):
+        values = self.values
+        if self.func:
+            values = self.func()
+            if not isinstance(values, dict):
+                values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield self.name, labels, '', value
+
+
+class Histogram(Metric):
+    """A distribution of observed values."""
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.counts = {}
+        self.sums = defaultdict(float)
+
+    def observe(self, value, *labels):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * len(self.buckets)
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def samples(self):
+        for labels, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                le = '+Inf' if bound == math.inf else repr(bound)
+                yield f'{self.name}_bucket', labels, f'le="{le}"', total
+            yield f'{self.name}_sum', labels, '', self.sums[labels]
+            yield f'{self.name}_count', labels, '', total
+
+
+def logfmt(value):
+    """Format a value for a structured log line."""
+    if isinstance(value, float):
+        return f'{value:.4f}'
+    value = str(value)
+    if not value or any(c in value for c in ' "='):
+        return '"' + value.replace('"', r'\"') + '"'
+    return value
+
+
+def log_slow(kind, name, elapsed, **context):
+    """Log a handler that held the event loop for too long."""
+    fields = {'slow': kind, kind: name, 'seconds': elapsed, **context}
+    print(' '.join(f'{k}={logfmt(v)}' for k, v in fields.items()))
+
+
+def record(kind, name, elapsed, **context):
+    """Record the time taken by a handler of the given kind.
+
+    `kind` is one of the keys of `latency`. `context`, such as the user and
+    the world, is only used in the slow log.
+
+    """
+    latency[kind].observe(elapsed, name)
+    if elapsed > SLOW_THRESHOLD:
+        log_slow(kind, name, elapsed, **context)
+
+
+def render():
+    """Render all metrics in Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def _clients():
+    from .client import Client
+    return len(Client.clients)
+
+
+def _outqueues():
+    from .client import Client
+    return {
+        (name,): c.outqueue.qsize()
+        for name, c in list(Client.clients.items())
+    }
+
+
+def _ticker():
+    from .scheduler import ticker
+    return ticker
+
+
+def _instances():
+    from .instances import worlds
+    return worlds.instances.values()
+
+
+def _live_worlds():
+    return {
+        (inst.name,): inst.world
+        for inst in list(_instances())
+        if inst.world
+    }
+
+
+messages_sent = Counter(
+    'darkworld_messages_sent_total',
+    'Messages sent to clients.',
+    ('op',)
+)
+bytes_sent = Counter(
+    'darkworld_message_bytes_sent_total',
+    'Bytes of encoded messages sent to clients.',
+    ('op',)
+)
+messages_received = Counter(
+    'darkworld_messages_received_total',
+    'Messages received from clients.',
+    ('op',)
+)
+bytes_received = Counter(
+    'darkworld_message_bytes_received_total',
+    'Bytes of messages received from clients.',
+    ('op',)
+)
+autosave_seconds = Histogram(
+    'darkworld_autosave_seconds',
+    'Time taken to save the world and all clients.'
+)
+autosave_bytes = Gauge(
+    'darkworld_autosave_bytes',
+    'Size of the light world save file.'
+)
+loop_lag_seconds = Histogram(
+    'darkworld_loop_lag_seconds',
+    'How late the event loop ran a callback that was due.'
+)
+loop_stalls = Counter(
+    'darkworld_loop_stalls_total',
+    'Times a callback blocked the event loop for too long.'
+)
+latency = {
+    'op': Histogram(
+        'darkworld_op_seconds',
+        'Time taken to handle each op from clients.',
+        ('op',),
+        LATENCY_BUCKETS
+    ),
+    'task': Histogram(
+        'darkworld_task_busy_seconds',
+        'Time that each kind of background task held the event loop.',
+        ('task',),
+        LATENCY_BUCKETS
+    ),
+    'event': Histogram(
+        'darkworld_event_seconds',
+        'Time taken to dispatch each kind of world event to subscribers.',
+        ('event',),
+        LATENCY_BUCKETS
+    ),
+}
+worldgen_seconds = Histogram(
+    'darkworld_worldgen_seconds',
+    'Time taken by each stage of world generation.',
+    ('stage',)
+)
+Gauge(
+    'darkworld_clients',
+    'Connected clients.',
+    func=_clients
+)
+Gauge(
+    'darkworld_client_outqueue_depth',
+    'Frames waiting to be sent to each client.',
+    ('client',),
+    func=_outqueues
+)
+Gauge(
+    'darkworld_tick_overruns',
+    'Ticks that took longer than the timestep to run.',
+    func=lambda: _ticker().overruns
+)
+Gauge(
+    'darkworld_ticks_dropped',
+    'Ticks skipped to catch up after falling behind.',
+    func=lambda: _ticker().dropped
+)
+Gauge(
+    'darkworld_worlds',
+    'Live worlds.',
+    func=lambda: len(_live_worlds())
+)
+Gauge(
+    'darkworld_world_population',
+    'Players in each registered world.',
+    ('world',),
+    func=lambda: {
+        (inst.name,): inst.population
+        for inst in list(_instances())
+    }
+)
+Gauge(
+    'darkworld_world_actors',
+    'Actors in each live world.',
+    ('world',),
+    func=lambda: {k: len(w.by_uid) for k, w in _live_worlds().items()}
+)
+Gauge(
+    'darkworld_world_enemies',
+    'Enemies controlled by the AI of each live world.',
+    ('world',),
+    func=lambda: {
+        k: len(w.ai)
+        for k, w in _live_worlds().items()
+        if getattr(w, 'ai', None)
+    }
+)
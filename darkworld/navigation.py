@@ -0,0 +1,310 @@
+"""Precomputed navigation data for worlds with static walls.
+
+The walls of a dark world are placed once when it is generated and never
+move. A NavGrid records which cells they block in a flat array, and groups
+the open cells into square clusters joined at their entrances, so that long
+paths can be planned over a small abstract graph (HPA*) and then refined one
+cluster at a time.
+
+Things that come and go - chests, loot, other mobs - are not part of the
+grid. Searches take them into account through a `blocked` callback that is
+only consulted in the local part of the search.
+
+"""
+import heapq
+from collections import deque, defaultdict
+
+from .coords import Rect, neighbours, manhattan_distance
+from .actor import Mob
+
+
+CLUSTER_SIZE = 8
+
+# Entrances wider than this get a transition at each end instead of one in
+# the middle
+WIDE_ENTRANCE = 6
+
+
+def is_obstacle(obj):
+    """Return True if obj blocks paths regardless of who is moving.
+
+    Mobs are not obstacles; they move about too much for paths around them to
+    be worth caching.
+
+    """
+    return obj is not None and not obj.standable and not isinstance(obj, Mob)
+
+
+class NavGrid:
+    """Passability of the static layer of a world, plus an HPA* graph."""
+
+    def __init__(self, bounds, blocked, cluster_size=CLUSTER_SIZE):
+        self.bounds = bounds
+        self.width = bounds.x2 - bounds.x1 + 1
+        self.blocked = blocked
+
+        self.cluster_size = cluster_size
+        self.nodes = defaultdict(set)
+        self.edges = defaultdict(dict)
+        self._build_entrances()
+        for cluster, nodes in self.nodes.items():
+            rect = self.cluster_rect(cluster)
+            for n in nodes:
+                dist = self._distances(n, rect)
+                for m in nodes:
+                    if m != n and m in dist:
+                        self.edges[n][m] = dist[m]
+
+    @classmethod
+    def from_cells(cls, walls, **kwargs):
+        """Construct a grid from a set of wall coordinates."""
+        xs = [x for x, y in walls]
+        ys = [y for x, y in walls]
+        bounds = Rect(min(xs), max(xs), min(ys), max(ys))
+        width = bounds.x2 - bounds.x1 + 1
+        blocked = bytearray(width * (bounds.y2 - bounds.y1 + 1))
+        for x, y in walls:
+            blocked[(y - bounds.y1) * width + x - bounds.x1] = 1
+        return cls(bounds, blocked, **kwargs)
+
+    @classmethod
+    def from_mask(cls, walls, x0, y0, **kwargs):
+        """Construct a grid from a numpy mask of walls.
+
+        The mask is indexed by [y - y0, x - x0].
+
+        """
+        ys, xs = walls.nonzero()
+        crop = walls[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+        bounds = Rect(
+            int(xs.min() + x0),
+            int(xs.max() + x0),
+            int(ys.min() + y0),
+            int(ys.max() + y0),
+        )
+        return cls(bounds, bytearray(crop.astype('u1').tobytes()), **kwargs)
+
+    def __repr__(self):
+        return (
+            f'<NavGrid {self.bounds} with {len(self.edges)} '
+            f'entrance cells>'
+        )
+
+    def _index(self, pos):
+        x, y = pos
+        return (y - self.bounds.y1) * self.width + x - self.bounds.x1
+
+    def passable(self, pos):
+        """Return True if no static wall blocks pos.
+
+        Everything outside the walls' bounding box is impassable.
+
+        """
+        return pos in self.bounds and not self.blocked[self._index(pos)]
+
+    def cluster_of(self, pos):
+        """Get the cluster coordinates for a cell."""
+        x, y = pos
+        return (
+            (x - self.bounds.x1) // self.cluster_size,
+            (y - self.bounds.y1) // self.cluster_size,
+        )
+
+    def cluster_rect(self, cluster):
+        """Get the cells covered by a cluster."""
+        cx, cy = cluster
+        size = self.cluster_size
+        x = self.bounds.x1 + cx * size
+        y = self.bounds.y1 + cy * size
+        return Rect(x, x + size - 1, y, y + size - 1)
+
+    def _build_entrances(self):
+        """Find the transitions between each pair of adjacent clusters."""
+        size = self.cluster_size
+        x1, x2, y1, y2 = self.bounds
+        # Vertical borders between horizontally adjacent clusters
+        for x in range(x1 + size - 1, x2, size):
+            self._add_entrances(
+                [((x, y), (x + 1, y)) for y in range(y1, y2 + 1)]
+            )
+        # Horizontal borders between vertically adjacent clusters
+        for y in range(y1 + size - 1, y2, size):
+            self._add_entrances(
+                [((x, y), (x, y + 1)) for x in range(x1, x2 + 1)]
+            )
+
+    def _add_entrances(self, pairs):
+        """Add transitions for each open run along a cluster border."""
+        run = []
+        for a, b in pairs:
+            is_open = self.passable(a) and self.passable(b)
+            if run and (
+                not is_open or
+                self.cluster_of(a) != self.cluster_of(run[0][0])
+            ):
+                self._add_transitions(run)
+                run = []
+            if is_open:
+                run.append((a, b))
+        if run:
+            self._add_transitions(run)
+
+    def _add_transitions(self, run):
+        if len(run) >= WIDE_ENTRANCE:
+            transitions = [run[0], run[-1]]
+        else:
+            transitions = [run[len(run) // 2]]
+        for a, b in transitions:
+            self.nodes[self.cluster_of(a)].add(a)
+            self.nodes[self.cluster_of(b)].add(b)
+            self.edges[a][b] = 1
+            self.edges[b][a] = 1
+
+    def _distances(self, start, rect, blocked=None):
+        """Breadth-first distances from start to open cells within rect."""
+        rect = Rect(
+            max(rect.x1, self.bounds.x1),
+            min(rect.x2, self.bounds.x2),
+            max(rect.y1, self.bounds.y1),
+            min(rect.y2, self.bounds.y2),
+        )
+        walls = self.blocked
+        index = self._index
+        dist = {start: 0}
+        edge = deque([start])
+        while edge:
+            pos = edge.popleft()
+            d = dist[pos] + 1
+            for p in neighbours(pos):
+                if p in dist or p not in rect or walls[index(p)]:
+                    continue
+                if blocked and blocked(p):
+                    continue
+                dist[p] = d
+                edge.append(p)
+        return dist
+
+    def local_path(self, start, goal, rect, blocked=None):
+        """Find a path from start to goal without leaving rect.
+
+        The goal itself is never considered blocked. Return a list of steps
+        ending at goal, or None if there is no path.
+
+        """
+        frontier = [(0, start)]
+        came_from = {start: None}
+        cost = {start: 0}
+        while frontier:
+            _, current = heapq.heappop(frontier)
+            if current == goal:
+                break
+            new_cost = cost[current] + 1
+            for p in neighbours(current):
+                if p not in rect or not self.passable(p):
+                    continue
+                if p != goal and blocked and blocked(p):
+                    continue
+                if p not in cost or new_cost < cost[p]:
+                    cost[p] = new_cost
+                    came_from[p] = current
+                    priority = new_cost + manhattan_distance(p, goal)
+                    heapq.heappush(frontier, (priority, p))
+        else:
+            return None
+
+        path = []
+        while goal != start:
+            path.append(goal)
+            goal = came_from[goal]
+        path.reverse()
+        return path
+
+    def _connect(self, pos, blocked):
+        """Get the costs from pos to the entrances of its cluster."""
+        cluster = self.cluster_of(pos)
+        dist = self._distances(pos, self.cluster_rect(cluster), blocked)
+        return {n: dist[n] for n in self.nodes.get(cluster, ()) if n in dist}
+
+    def find_path(self, start, goal, blocked=None):
+        """Find a path from start to goal.
+
+        Return a list of steps ending at goal, or None if there is no path.
+
+        """
+        if self.cluster_of(start) == self.cluster_of(goal):
+            rect = self.cluster_rect(self.cluster_of(start))
+            path = self.local_path(start, goal, rect, blocked)
+            if path:
+                return path
+
+        # Plan over the abstract graph, with start and goal temporarily
+        # joined to the entrances of their clusters
+        from_start = self._connect(start, blocked)
+        to_goal = self._connect(goal, blocked)
+        frontier = [(0, start)]
+        came_from = {start: None}
+        cost = {start: 0}
+        while frontier:
+            _, current = heapq.heappop(frontier)
+            if current == goal:
+                break
+            edges = dict(self.edges.get(current, ()))
+            if current == start:
+                edges.update(from_start)
+            if current in to_goal:
+                edges[goal] = to_goal[current]
+            for n, c in edges.items():
+                new_cost = cost[current] + c
+                if n not in cost or new_cost < cost[n]:
+                    cost[n] = new_cost
+                    came_from[n] = current
+                    priority = new_cost + manhattan_distance(n, goal)
+                    heapq.heappush(frontier, (priority, n))
+        else:
+            return None
+
+        waypoints = []
+        node = goal
+        while node is not None:
+            waypoints.append(node)
+            node = came_from[node]
+        waypoints.reverse()
+
+        # Refine each abstract edge into steps
+        path = []
+        for a, b in zip(waypoints, waypoints[1:]):
+            if manhattan_distance(a, b) == 1:
+                path.append(b)
+                continue
+            rect = self.cluster_rect(self.cluster_of(b))
+            segment = self.local_path(a, b, rect, blocked)
+            if segment is None:
+                # Something not in the static grid is in the way; fall back
+                # to searching the whole grid
+                return self.local_path(start, goal, self.bounds, blocked)
+            path.extend(segment)
+        return path
+
+
+def find_path(world, start, goal):
+    """Find a path between two points in a world.
+
+    Worlds with a NavGrid are searched hierarchically; others fall back to a
+    plain A* search over the grid. Return a list of steps ending at goal, or
+    None if there is no path.
+
+    """
+    if world.nav is None:
+        from .ai import a_star_search
+        try:
+            path = a_star_search(world, start, goal)
+        except KeyError:
+            return None
+        path.reverse()
+        path.append(goal)
+        return path
+
+    def blocked(pos):
+        return is_obstacle(world.get(pos))
+
+    return world.nav.find_path(start, goal, blocked)
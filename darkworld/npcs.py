@@ -1,8 +1,8 @@
-import asyncio
 from .dialog import ShopDialog, BlacksmithDialog
 from .coords import Direction
 from .actor import NPC, Scenery, Large
 from .asyncutils import start_coroutine
+from .scheduler import ticker
 from .items import (
     InsufficientItems, Torch, Elixir, Axe, Compass, AdventurerSword
 )
@@ -17,12 +17,12 @@ class Woodsman(NPC):
         self.face(pc)
         pc.client.say(self.title, "Hello there!")
         if not pc.client.can('teleport'):
-            await asyncio.sleep(0.5)
+            await ticker.sleep(0.5)
             pc.client.say(self.title, "Have you seen the magician yet?")
-            await asyncio.sleep(1)
+            await ticker.sleep(1)
             pc.client.say(self.title, "Just follow this road to the left.")
         else:
-            await asyncio.sleep(0.5)
+            await ticker.sleep(0.5)
             pc.client.say(self.title, "I have some things for sale.")
             pc.client.show_dialog(ShopDialog({
                 Torch: 10,
@@ -38,13 +38,13 @@ class Magician(NPC):
     @start_coroutine
     async def on_act(self, pc):
         self.face(pc)
-        await asyncio.sleep(0.5)
+        await ticker.sleep(0.5)
         pc.client.say(
             self.title,
             "The stone rings? They're powered by mushrooms!"
         )
         pc.client.grant('teleport')
-        await asyncio.sleep(2)
+        await ticker.sleep(2)
         self.direction = Direction.NORTH
         self.move(self.pos)
 
@@ -81,7 +81,7 @@ class Forager(NPC):
 
         if pc.client.can('eat_shrooms'):
             pc.client.say(self.title, "That's all I know!")
-            await asyncio.sleep(2)
+            await ticker.sleep(2)
             pc.client.say(
                 self.title,
                 "If you find any mushrooms, I'll buy them "
@@ -92,7 +92,7 @@ class Forager(NPC):
 
         if not pc.client.can('start_forage'):
             pc.client.say(self.title, "Sure, I can teach you about foraging.")
-            await asyncio.sleep(2)
+            await ticker.sleep(2)
             try:
                 pc.client.inventory.take('mushroom', 5)
             except InsufficientItems:
@@ -102,7 +102,7 @@ class Forager(NPC):
                     self.title,
                     "I see you have some mushrooms already."
                 )
-                await asyncio.sleep(2)
+                await ticker.sleep(2)
                 pc.client.say(
                     self.title,
                     "You can only eat these ones. Let's throw the others away."
@@ -117,9 +117,9 @@ class Blacksmith(NPC):
     @start_coroutine
     async def on_act(self, pc):
         self.face(pc)
-        await asyncio.sleep(0.5)
+        await ticker.sleep(0.5)
         pc.client.say(self.title, "Aye, I can sort ye out with some tools.")
-        await asyncio.sleep(2)
+        await ticker.sleep(2)
         pc.client.say(self.title, "If ye have the metal.")
         pc.client.show_dialog(BlacksmithDialog({
             Axe: 10,
@@ -2,7 +2,7 @@ import pickle
 import tempfile
 from pathlib import Path
 
-from .world_gen import create_light_world
+from .world_gen import create_light_world, generate_terrain, terrain_key
 
 
 savedir = Path.cwd() / 'savedata'
@@ -10,6 +10,7 @@ world_file = 'light_world.pck'
 
 
 def pickle_atomic(outfile, data):
+    """Pickle data to outfile, returning the number of bytes written."""
     assert outfile.endswith('.pck')
     if not savedir.exists():
         # FIXME: this bit is not atomic
@@ -22,11 +23,14 @@ def pickle_atomic(outfile, data):
     )
     try:
         pickle.dump(data, tmpfile, -1)
+        size = tmpfile.tell()
+        tmpfile.close()
     except BaseException:
         Path(tmpfile.name).unlink()
         raise
     else:
         Path(tmpfile.name).rename(savedir / outfile)
+        return size
 
 
 def load_pickle(name):
@@ -38,16 +42,40 @@ def load_pickle(name):
         return pickle.load(f)
 
 
+def load_terrain():
+    """Load the light world terrain from the cache, generating it if needed.
+
+    Cache files are named by a hash of the heightmap and the generation
+    parameters, so any change to those misses the cache.
+
+    """
+    cache_file = f'terrain-{terrain_key()[:16]}.pck'
+    terrain = load_pickle(cache_file)
+    if terrain:
+        print(f'Terrain loaded from {cache_file}')
+        return terrain
+
+    terrain = generate_terrain()
+    for stale in savedir.glob('terrain-*.pck'):
+        stale.unlink()
+    pickle_atomic(cache_file, terrain)
+    return terrain
+
+
 def init_world():
     from . import client
     client.light_world = load_pickle(world_file)
     if client.light_world:
         print(f'World loaded from {world_file}')
     else:
-        client.light_world = create_light_world()
+        client.light_world = create_light_world(load_terrain())
+
+    from .instances import worlds
+    worlds.register(client.light_world, 'light', persistent=True)
 
 
 def save_world():
     from . import client
-    pickle_atomic(world_file, client.light_world)
+    size = pickle_atomic(world_file, client.light_world)
     print(f'World state saved to {world_file}')
+    return size
@@ -0,0 +1,172 @@
+"""A sampling profiler that can be run over the live server.
+
+A helper thread samples the event loop thread's Python stack every
+SAMPLE_INTERVAL seconds. Nothing is traced, so the server runs at close to
+full speed while profiling. The samples are written as collapsed stacks -
+one line per distinct stack, frames separated by semicolons, followed by
+the number of samples - which flamegraph.pl and speedscope can read.
+
+Sampling can't say how often a function was called, so while profiling a
+few functions of interest are wrapped to count their calls.
+
+"""
+import asyncio
+import importlib
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+from pathlib import Path
+
+
+# Seconds between samples
+SAMPLE_INTERVAL = 0.005
+
+# Longest allowed profiling run, in seconds
+MAX_SECONDS = 60
+
+# Functions whose calls are counted while profiling, as (module, attribute)
+COUNTED = [
+    ('darkworld.world', 'World.query'),
+    ('darkworld.world', 'World.reveal'),
+    ('darkworld.ai', 'EnemyAI.think'),
+    ('darkworld.ai', 'VectorEnemyAI.think'),
+    ('darkworld.ai', 'EnemyAI.chase_step'),
+    ('darkworld.ai', 'FlowField.__init__'),
+    ('darkworld.navigation', 'NavGrid.find_path'),
+    ('darkworld.backends', 'dumps'),
+]
+
+outdir = Path.cwd() / 'profiles'
+
+
+def frame_name(frame):
+    """Get the name of a frame for a collapsed stack."""
+    module = frame.f_globals.get('__name__', '?')
+    return f'{module}:{frame.f_code.co_name}'
+
+
+def collapse(frame):
+    """Get the collapsed stack of a frame, outermost first."""
+    names = []
+    while frame:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    """Sample the stack of the event loop thread for a while."""
+
+    def __init__(self):
+        self.thread = None
+        self.samples = Counter()
+        self.calls = Counter()
+        self.patched = []
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, seconds, callback):
+        """Profile for the given number of seconds.
+
+        When done, callback(path, summary) is called on the event loop
+        thread. Return False if a profile is already running.
+
+        """
+        if self.running:
+            return False
+        seconds = min(seconds, MAX_SECONDS)
+        self.samples.clear()
+        self.calls.clear()
+        self._patch()
+        loop = asyncio.get_event_loop()
+        self.thread = threading.Thread(
+            target=self._sample,
+            args=(threading.get_ident(), seconds, loop, callback),
+            name='profiler',
+            daemon=True
+        )
+        self.thread.start()
+        return True
+
+    def _patch(self):
+        """Wrap the functions in COUNTED to count their calls."""
+        from .scheduler import ticker
+
+        names = {}
+        for modname, attr in COUNTED:
+            obj = importlib.import_module(modname)
+            *path, name = attr.split('.')
+            for p in path:
+                obj = getattr(obj, p)
+            func = getattr(obj, name)
+            setattr(obj, name, self._counting(func, attr))
+            self.patched.append((obj, name, func))
+            names[func] = attr
+
+        # Systems were scheduled with bound methods, which still refer to
+        # the unwrapped functions
+        for scheduler in list(ticker.schedulers):
+            for system in scheduler.systems:
+                attr = names.get(getattr(system.func, '__func__', None))
+                if attr:
+                    func = system.func
+                    system.func = self._counting(func, attr)
+                    self.patched.append((system, 'func', func))
+
+    def _unpatch(self):
+        for obj, name, func in reversed(self.patched):
+            setattr(obj, name, func)
+        self.patched.clear()
+
+    def _counting(self, func, name):
+        calls = self.calls
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            calls[name] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    def _sample(self, thread_id, seconds, loop, callback):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            frame = sys._current_frames().get(thread_id)
+            if frame:
+                self.samples[collapse(frame)] += 1
+            del frame
+            time.sleep(SAMPLE_INTERVAL)
+        loop.call_soon_threadsafe(self._finish, callback)
+
+    def _finish(self, callback):
+        self._unpatch()
+        self.thread = None
+        path = self.write()
+        calls = ', '.join(
+            f'{name}={n}' for name, n in self.calls.most_common()
+        )
+        summary = (
+            f'{sum(self.samples.values())} samples; '
+            f'calls: {calls or "none"}'
+        )
+        print(f'Profile written to {path}: {summary}')
+        callback(path, summary)
+
+    def write(self):
+        """Write the collapsed stacks and call counts of the last profile."""
+        outdir.mkdir(exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = outdir / f'profile-{stamp}.folded'
+        with path.open('w') as f:
+            for stack, n in self.samples.most_common():
+                f.write(f'{stack} {n}\n')
+        with path.with_suffix('.calls').open('w') as f:
+            for name, n in self.calls.most_common():
+                f.write(f'{name} {n}\n')
+        return path
+
+
+profiler = Profiler()
@@ -0,0 +1,199 @@
+"""Record client sessions and replay them headlessly.
+
+A recording is a directory holding a snapshot of the light world, the save
+files of the users who connected, and events.jsonl - every message received
+from clients, stamped with the tick it arrived on, plus the seed of the
+global random generator and of each dark world created. Authentication
+tokens are not recorded.
+
+Replaying loads the snapshot into a scratch save directory and feeds the
+same messages to in-process clients on the same ticks, as fast as possible
+or at a chosen speed. It reports the messages sent and the CPU time used, so
+that two builds can be compared on an identical workload.
+
+"""
+import asyncio
+import itertools
+import json
+import pickle
+import random
+import shutil
+import tempfile
+import time
+import weakref
+from pathlib import Path
+
+from . import persistence
+from . import metrics
+from .scheduler import ticker
+
+
+# The recorder, if we are recording
+recorder = None
+
+# Seconds to keep simulating after the last recorded event
+LINGER = 5.0
+
+# Recordings never hold real authentication tokens: every token, in the
+# auth messages and in the copied save files, is replaced with this one
+REPLAY_TOKEN = 'replay'
+
+
+class Recorder:
+    """Record the messages received from clients to a directory."""
+
+    def __init__(self, path):
+        from . import client
+
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ids = weakref.WeakKeyDictionary()
+        self.seq = itertools.count(1)
+        self.users = set()
+        self.start_tick = ticker.tick
+        self.start_time = time.monotonic()
+
+        self.seed = random.getrandbits(32)
+        random.seed(self.seed)
+        with (self.path / 'world.pck').open('wb') as f:
+            pickle.dump(client.light_world, f, -1)
+        self.events = (self.path / 'events.jsonl').open('w', buffering=1)
+        self.log('start', seed=self.seed)
+
+    def log(self, event, client=None, **kwargs):
+        record = {
+            'tick': ticker.tick - self.start_tick,
+            't': round(time.monotonic() - self.start_time, 4),
+            'event': event,
+        }
+        if client is not None:
+            record['client'] = self.ids.get(client)
+        record.update(kwargs)
+        self.events.write(json.dumps(record) + '\n')
+
+    def connected(self, client):
+        self.ids[client] = next(self.seq)
+        self.log('connect', client)
+
+    def closed(self, client):
+        self.log('close', client)
+
+    def received(self, client, op, msg):
+        if op == 'auth':
+            self.copy_user(msg.get('name'))
+            msg = {**msg, 'token': REPLAY_TOKEN}
+        self.log('msg', client, msg={'op': op, **msg})
+
+    def world_created(self, world):
+        self.log('world', seed=world.seed)
+
+    def copy_user(self, name):
+        """Copy a user's save files, as they were before they connected.
+
+        The token in the user data is replaced with REPLAY_TOKEN.
+
+        """
+        from .client import NAME_RE
+        if name in self.users or not NAME_RE.match(str(name)):
+            return
+        self.users.add(name)
+        data = persistence.load_pickle(f'{name}-user.pck')
+        if data is not None:
+            data['token'] = REPLAY_TOKEN
+            with (self.path / f'{name}-user.pck').open('wb') as f:
+                pickle.dump(data, f, -1)
+        src = persistence.savedir / f'{name}-inventory.pck'
+        if src.exists():
+            shutil.copy(src, self.path / src.name)
+
+    def close(self):
+        self.events.close()
+
+
+def start_recording(path):
+    """Start recording client sessions to the directory path."""
+    global recorder
+    recorder = Recorder(path)
+    print(f'Recording client sessions to {path}')
+
+
+def stop_recording():
+    global recorder
+    if recorder:
+        recorder.close()
+        recorder = None
+
+
+async def replay(path, speed=None, linger=LINGER):
+    """Replay a recording, returning a report of the work done.
+
+    With `speed` None, ticks run back to back; otherwise simulated time
+    runs `speed` times faster than real time.
+
+    """
+    path = Path(path)
+    with (path / 'events.jsonl').open() as f:
+        events = [json.loads(line) for line in f]
+    start, *events = events
+
+    scratch = tempfile.TemporaryDirectory()
+    savedir = persistence.savedir
+    persistence.savedir = Path(scratch.name)
+    try:
+        return await _replay(path, start, events, speed, linger)
+    finally:
+        persistence.savedir = savedir
+        scratch.cleanup()
+
+
+async def _replay(path, start, events, speed, linger):
+    """Replay events into persistence.savedir, returning a report."""
+    from . import ecosystem
+    from .simulation import HeadlessClient
+    from .instances import dark_worlds
+
+    shutil.copy(path / 'world.pck', persistence.savedir / 'light_world.pck')
+    for f in path.glob('*-*.pck'):
+        shutil.copy(f, persistence.savedir / f.name)
+
+    persistence.init_world()
+    random.seed(start['seed'])
+    ecosystem.setup_systems()
+    dark_worlds.seeds.extend(e['seed'] for e in events if e['event'] == 'world')
+
+    async def step():
+        ticker.step()
+        await asyncio.sleep(ticker.timestep / speed if speed else 0)
+
+    sent = dict(metrics.messages_sent.values)
+    sent_bytes = dict(metrics.bytes_sent.values)
+    clients = {}
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    first_tick = ticker.tick
+
+    for e in events:
+        while ticker.tick - first_tick < e['tick']:
+            await step()
+        kind = e['event']
+        if kind == 'connect':
+            clients[e['client']] = HeadlessClient()
+        elif kind == 'msg':
+            await clients[e['client']].handle_message(dict(e['msg']))
+        elif kind == 'close':
+            clients.pop(e['client']).close()
+
+    for _ in range(ticker.to_ticks(linger)):
+        await step()
+    for c in clients.values():
+        c.close()
+
+    return {
+        'ticks': ticker.tick - first_tick,
+        'simulated_seconds': (ticker.tick - first_tick) * ticker.timestep,
+        'wall_seconds': time.perf_counter() - wall,
+        'cpu_seconds': time.process_time() - cpu,
+        'messages_received': sum(1 for e in events if e['event'] == 'msg'),
+        'messages_sent': metrics.messages_sent.since(sent),
+        'bytes_sent': metrics.bytes_sent.since(sent_bytes),
+    }
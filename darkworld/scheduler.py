@@ -0,0 +1,241 @@
+"""Fixed-timestep scheduling of the simulation.
+
+Each world has a Scheduler holding the systems that simulate it - enemy AI,
+the ecosystem and so on - and any one-off timers. A single Ticker advances
+every live scheduler on a fixed timestep from the event loop, so that the
+amount of simulation work done in one loop iteration is bounded.
+
+If the work for a tick runs over its time budget, the remaining low-priority
+systems are deferred to the next tick. If the loop falls behind, the ticker
+catches up a few ticks at a time and drops the rest.
+
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import traceback
+import weakref
+from timeit import default_timer
+
+
+# Seconds of simulated time per tick
+TIMESTEP = 0.05
+
+# Seconds of work allowed per tick before deferring low-priority systems
+TICK_BUDGET = 0.025
+
+# Ticks to run back-to-back when behind, before dropping ticks instead
+MAX_CATCHUP = 5
+
+# Systems of this priority or above are never deferred
+ESSENTIAL = 10
+
+
+class System:
+    """A function run by a scheduler at a regular interval."""
+
+    def __init__(self, func, interval, priority, name):
+        self.func = func
+        self.interval = interval
+        self.priority = priority
+        self.name = name or getattr(func, '__qualname__', repr(func))
+        self.next_tick = None
+        self.deferred = 0
+
+    def __repr__(self):
+        return f'<System {self.name} every {self.interval} ticks>'
+
+
+class Timer:
+    """A handle to a function scheduled to run once."""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop the function from being called."""
+        self.cancelled = True
+
+
+class Scheduler:
+    """The systems and timers of one world."""
+
+    def __init__(self, name, ticker):
+        self.name = name
+        self.ticker = ticker
+        self.systems = []
+        self.timers = []
+        self.seq = itertools.count()
+
+    def __repr__(self):
+        return f'<Scheduler {self.name}>'
+
+    def add_system(self, func, interval, priority=0, name=None):
+        """Call func every `interval` seconds of simulated time.
+
+        Systems with higher priority run earlier in each tick. Those below
+        ESSENTIAL priority may be deferred when a tick is over budget.
+
+        """
+        interval = self.ticker.to_ticks(interval)
+        system = System(func, interval, priority, name)
+        system.next_tick = self.ticker.tick + system.interval
+        self.systems.append(system)
+        self.systems.sort(key=lambda s: -s.priority)
+        return system
+
+    def remove_system(self, system):
+        """Stop running a system."""
+        self.systems.remove(system)
+
+    def call_later(self, delay, func, *args):
+        """Call func(*args) after `delay` seconds of simulated time."""
+        timer = Timer(func, args)
+        due = self.ticker.tick + self.ticker.to_ticks(delay)
+        heapq.heappush(self.timers, (due, next(self.seq), timer))
+        return timer
+
+    def next_due(self):
+        """Get the next tick at which a timer or system is due, if any."""
+        due = [s.next_tick for s in self.systems]
+        if self.timers:
+            due.append(self.timers[0][0])
+        return min(due, default=None)
+
+    def run_tick(self, tick, deadline):
+        """Run the timers and systems due at the given tick."""
+        timers = self.timers
+        while timers and timers[0][0] <= tick:
+            _, _, timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                try:
+                    timer.func(*timer.args)
+                except Exception:
+                    traceback.print_exc()
+
+        for system in self.systems:
+            if system.next_tick > tick:
+                continue
+            if system.priority < ESSENTIAL and default_timer() > deadline:
+                system.next_tick = tick + 1
+                system.deferred += 1
+                continue
+            system.next_tick = tick + system.interval
+            try:
+                system.func()
+            except Exception:
+                traceback.print_exc()
+
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+class Ticker:
+    """Drive all live schedulers on a fixed timestep.
+
+    Schedulers are held weakly, so a world's systems stop when the world is
+    deallocated. The `main` scheduler is for work that belongs to no world.
+
+    """
+
+    def __init__(self, timestep=TIMESTEP, budget=TICK_BUDGET):
+        self.timestep = timestep
+        self.budget = budget
+        self.tick = 0
+        self.schedulers = weakref.WeakSet()
+        self.end_of_tick = []
+        self.dropped = 0
+        self.overruns = 0
+        self.task = None
+        self.main = self.new_scheduler('main')
+
+    @property
+    def time(self):
+        """Get the simulated time in seconds."""
+        return self.tick * self.timestep
+
+    def to_ticks(self, seconds):
+        """Convert a duration in seconds to a whole number of ticks."""
+        return max(1, math.ceil(seconds / self.timestep - 1e-9))
+
+    def new_scheduler(self, name):
+        """Create a scheduler driven by this ticker."""
+        scheduler = Scheduler(name, self)
+        self.schedulers.add(scheduler)
+        return scheduler
+
+    def at_end_of_tick(self, func):
+        """Call func after every tick, once the simulation has run."""
+        self.end_of_tick.append(func)
+
+    def step(self):
+        """Advance the simulation by one tick."""
+        self.tick += 1
+        start = default_timer()
+        deadline = start + self.budget
+        for scheduler in list(self.schedulers):
+            scheduler.run_tick(self.tick, deadline)
+        for func in self.end_of_tick:
+            try:
+                func()
+            except Exception:
+                traceback.print_exc()
+        if default_timer() - start > self.timestep:
+            self.overruns += 1
+
+    def next_due(self):
+        """Get the next tick at which any scheduler has work to do, if any."""
+        due = [s.next_due() for s in list(self.schedulers)]
+        return min((t for t in due if t is not None), default=None)
+
+    def skip_to(self, tick):
+        """Advance the clock to `tick` without running the ticks in between.
+
+        This is only correct if nothing is due before then; see next_due().
+        It lets a headless simulation pass quickly over idle time.
+
+        """
+        self.tick = max(self.tick, tick)
+
+    async def sleep(self, seconds):
+        """Sleep for `seconds` of simulated time."""
+        fut = asyncio.get_event_loop().create_future()
+        self.main.call_later(seconds, _wake, fut)
+        await fut
+
+    async def run(self):
+        """Step the simulation in real time until cancelled."""
+        loop = asyncio.get_event_loop()
+        next_time = loop.time()
+        try:
+            while True:
+                now = loop.time()
+                behind = int((now - next_time) / self.timestep)
+                if behind > MAX_CATCHUP:
+                    skip = behind - MAX_CATCHUP
+                    self.dropped += skip
+                    next_time += skip * self.timestep
+                while next_time <= now:
+                    self.step()
+                    next_time += self.timestep
+                await asyncio.sleep(next_time - loop.time())
+        except asyncio.CancelledError:
+            return
+
+    def start(self):
+        """Start running in real time on the event loop."""
+        if not self.task:
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+
+ticker = Ticker()
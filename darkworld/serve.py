@@ -1,8 +1,21 @@
 import asyncio
+import functools
+import hmac
+import ipaddress
+import os
 
 import aiohttp
 from aiohttp import web
+from . import client
 from .client import Client
+from . import backends
+from . import metrics
+from . import replay
+from . import gcmonitor
+from . import shards
+from .instances import worlds
+from .watchdog import watchdog
+from .memory import MemoryReport
 
 from .ecosystem import start_processes, stop_processes
 from .persistence import init_world, save_world
@@ -17,11 +30,67 @@ async def index(request):
         )
 
 
+# Token that lets other hosts fetch diagnostics, if set
+ADMIN_TOKEN = os.environ.get('DARKWORLD_ADMIN_TOKEN')
+
+
+def is_admin(request):
+    """Return True if a request comes from localhost or bears ADMIN_TOKEN."""
+    try:
+        if ipaddress.ip_address(request.remote).is_loopback:
+            return True
+    except ValueError:
+        pass
+    if not ADMIN_TOKEN:
+        return False
+    token = request.query.get('token', '')
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        token = auth[len('Bearer '):]
+    return hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+def internal(handler):
+    """Serve a diagnostics endpoint only to admins; see is_admin()."""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        if not is_admin(request):
+            raise web.HTTPForbidden()
+        return await handler(request)
+    return wrapper
+
+
+async def get_metrics(request):
+    """Serve metrics in Prometheus text format."""
+    return web.Response(
+        content_type='text/plain',
+        text=metrics.render()
+    )
+
+
+@internal
+async def get_stalls(request):
+    """Serve a report of recent event loop lag and stalls."""
+    return web.Response(
+        content_type='text/plain',
+        text=watchdog.report()
+    )
+
+
+@internal
+async def get_memory(request):
+    """Serve a report of the memory used by worlds, actors and clients."""
+    return web.Response(
+        content_type='text/plain',
+        text=MemoryReport().format()
+    )
+
+
 async def open_ws(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
     c = Client(ws)
-    loop.create_task(c.sender())
+    asyncio.ensure_future(c.sender())
     await c.receiver()
     return web.Response()
 
@@ -30,10 +99,22 @@ app = web.Application()
 app.add_routes([
     web.get('/', index),
     web.get('/ws', open_ws),
+    web.get('/metrics', get_metrics),
+    web.get('/stalls', get_stalls),
+    web.get('/memory', get_memory),
     web.static('/', 'assets'),
 ])
 
 
+async def on_startup(app):
+    start_processes()
+    if app['workers']:
+        await shards.pool.start(app['workers'])
+        worlds.shards = shards.pool
+
+app.on_startup.append(on_startup)
+
+
 async def on_shutdown(app):
     for c in list(Client.clients.values()):
         ws = c.ws
@@ -41,16 +122,39 @@ async def on_shutdown(app):
             code=aiohttp.WSCloseCode.GOING_AWAY,
             message='Server shutdown'
         )
+    await shards.pool.drain()
+    shards.pool.stop()
     stop_processes()
     save_world()
+    replay.stop_recording()
 
 app.on_shutdown.append(on_shutdown)
 
-loop = asyncio.get_event_loop()
 
+def run_server(*, port=8000, record=None, workers=None, loadtest=None):
+    """Run the server.
+
+    If `record` is given, or DARKWORLD_RECORD is set, client sessions are
+    recorded to that directory for replaying later. If `workers` is given,
+    or DARKWORLD_WORKERS is set, dark worlds are run in that many worker
+    processes.
 
-def run_server(*, port=8000):
-    """Run the server."""
+    If `loadtest` is true, or DARKWORLD_LOADTEST is set, the bots connected
+    by loadtest.py may use the teleporters and are never saved.
+
+    """
+    if record is None:
+        record = os.environ.get('DARKWORLD_RECORD')
+    if workers is None:
+        workers = int(os.environ.get('DARKWORLD_WORKERS') or 0)
+    if loadtest is None:
+        loadtest = bool(os.environ.get('DARKWORLD_LOADTEST'))
+    client.loadtest = loadtest
+    backends.select()
+    gcmonitor.configure()
     init_world()
-    start_processes()
+    gcmonitor.freeze()
+    if record:
+        replay.start_recording(record)
+    app['workers'] = workers
     web.run_app(app, port=port)
@@ -0,0 +1,444 @@
+"""Run dark worlds in worker processes.
+
+The gateway - the process running the web server - terminates the
+websockets and runs the light world. Dark world instances are spread over
+worker processes, each with its own event loop and ticker, so the game can
+use more than one core.
+
+When players teleport into a dark world, the gateway hands them to the
+worker that runs it, with their inventory, gold and health. Their ops are
+forwarded to the worker, and the frames the worker sends them are passed
+back through to their websockets. When they go home, die or disconnect,
+the worker hands them back and the gateway respawns or saves them. If a
+worker dies, its players are sent home as they were when they left, and
+the worker is restarted.
+
+Workers talk to the gateway over Unix sockets, with length-prefixed pickles.
+Start one with::
+
+    $ python -m darkworld.shards /path/to/socket
+
+though normally the gateway starts them itself; see ShardPool.
+
+"""
+import asyncio
+import itertools
+import pickle
+import random
+import struct
+import sys
+import tempfile
+from pathlib import Path
+
+from . import client
+from .actor import PC
+from .client import Client, ClientSight
+from .instances import worlds, INSTANCE_CAPACITY, MAX_INSTANCES
+from .scheduler import ticker
+from .world import Collision
+from .world_gen import create_dark_world
+
+
+# Seconds to wait for a worker to start listening
+START_TIMEOUT = 30
+
+# Seconds to wait before replacing a worker that has died
+RESTART_DELAY = 1.0
+
+# Told to players whose worker dies while they are in a dark world
+LOST_MSG = 'The dark world collapsed around you!'
+
+
+class Connection:
+    """Send and receive pickled tuples over a stream."""
+
+    header = struct.Struct('!I')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, *msg):
+        data = pickle.dumps(msg, -1)
+        self.writer.write(self.header.pack(len(data)) + data)
+
+    async def recv(self):
+        """Receive a message, or None if the other end has gone away."""
+        try:
+            header = await self.reader.readexactly(self.header.size)
+            size, = self.header.unpack(header)
+            return pickle.loads(await self.reader.readexactly(size))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    def close(self):
+        self.writer.close()
+
+
+# Worker side
+
+class Home:
+    """The light world, as seen from a worker.
+
+    Players who teleport home are handed back to the gateway.
+
+    """
+    remote = True
+
+    def admit(self, pc, pos):
+        pc.client.leave()
+
+
+class RemoteClient(Client):
+    """A player in one of this worker's worlds, connected via the gateway."""
+
+    def __init__(self, worker, state):
+        super().__init__(None)
+        self.worker = worker
+        self.name = state['name']
+        self.token = state['token']
+        self._gold = state['gold']
+        self.caps = state['caps']
+        self.inventory = state['inventory']
+        self.left = False
+
+    def flush(self):
+        frame = self.pop_frame()
+        if frame:
+            self.worker.conn.send('out', self.name, frame)
+
+    def save(self):
+        """The gateway saves players once they are handed back."""
+
+    def respawn(self, msg=None, health=None):
+        """Players respawn in the light world, so hand them back."""
+        self.leave(msg)
+
+    def leave(self, msg=None):
+        """Hand the player back to the gateway."""
+        if self.left:
+            return
+        self.left = True
+        self.flush()
+        Client.dirty.discard(self)
+        self.sight.stop()
+        self.worker.clients.pop(self.name, None)
+        Client.clients.pop(self.name, None)
+        self.worker.conn.send('left', self.name, self.get_state(), msg)
+
+
+class Worker:
+    """Run dark worlds for the gateway."""
+
+    def __init__(self):
+        self.conn = None
+        self.clients = {}
+        self.instances = {}
+        self.done = asyncio.get_event_loop().create_future()
+
+    def world_for(self, instance, seed):
+        """Get the world for an instance, creating it if necessary."""
+        inst = self.instances.get(instance)
+        if inst and inst.world and not inst.released_at:
+            return inst.world
+        for k, inst in list(self.instances.items()):
+            if inst.released_at:
+                del self.instances[k]
+        world = create_dark_world(seed)
+        self.instances[instance] = worlds.register(world, f'dark-{instance}')
+        return world
+
+    async def serve(self, reader, writer):
+        """Handle messages from the gateway until it disconnects."""
+        self.conn = Connection(reader, writer)
+        while True:
+            msg = await self.conn.recv()
+            if msg is None:
+                break
+            kind, *args = msg
+            try:
+                await getattr(self, f'on_{kind}')(*args)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+        self.done.set_result(None)
+
+    async def on_join(self, name, instance, seed, state, pos):
+        world = self.world_for(instance, seed)
+        c = RemoteClient(self, state)
+        self.clients[name] = Client.clients[name] = c
+        actor = c.actor = PC(c)
+        actor.health = state['health']
+        actor.world = world
+        actor.pos = pos
+        c.handle_refresh()
+        c.sight = ClientSight(actor)
+        try:
+            actor.spawn(world, pos=pos, effect='teleport')
+        except Collision:
+            actor.spawn(world, effect='teleport')
+
+    async def on_op(self, name, op, msg):
+        c = self.clients.get(name)
+        if c:
+            await c.handle_message({'op': op, **msg})
+
+    async def on_disconnect(self, name):
+        c = self.clients.get(name)
+        if not c:
+            return
+        if c.actor.alive:
+            c.actor.kill(effect='disconnect')
+        c.leave()
+
+
+def worker_main(path):
+    """Run a worker, serving the gateway on the Unix socket at path."""
+    loop = asyncio.get_event_loop()
+    worker = Worker()
+    client.light_world = Home()
+    ticker.at_end_of_tick(Client.flush_all)
+    worlds.start()
+    ticker.start()
+    loop.run_until_complete(asyncio.start_unix_server(worker.serve, path))
+    loop.run_until_complete(worker.done)
+    ticker.stop()
+
+
+# Gateway side
+
+class RemoteWorld:
+    """A dark world instance run by a worker."""
+    remote = True
+
+    def __init__(self, pool, worker, id, seed):
+        self.pool = pool
+        self.worker = worker
+        self.id = id
+        self.seed = seed
+        self.population = 0
+        self.arriving = 0
+
+    def __repr__(self):
+        return f'<RemoteWorld {self.id} on worker {self.worker.index}>'
+
+    @property
+    def room(self):
+        """The number of players who can still join this instance."""
+        return INSTANCE_CAPACITY - self.population - self.arriving
+
+    def admit(self, pc, pos):
+        """Hand a player over to the worker."""
+        c = pc.client
+        self.arriving = max(0, self.arriving - 1)
+        if Client.clients.get(c.name) is not c:
+            # They disconnected on the way
+            self.release()
+            return
+        if not self.worker.alive:
+            # The worker died while they were on their way
+            c.respawn(LOST_MSG, health=pc.health)
+            return
+        c.sight.stop()
+        c.remote = self
+        self.population += 1
+        self.worker.population += 1
+        self.pool.sessions[c.name] = c
+        self.worker.conn.send('join', c.name, self.id, self.seed,
+                              c.get_state(), pos)
+
+    def send_op(self, c, op, msg):
+        self.worker.conn.send('op', c.name, op, msg)
+
+    def disconnect(self, c):
+        self.worker.conn.send('disconnect', c.name)
+
+    def left(self):
+        """Account for a player that has been handed back."""
+        self.population -= 1
+        self.worker.population -= 1
+        self.release()
+
+    def release(self):
+        """Forget the instance if nobody is in it or on their way."""
+        if self.population + self.arriving <= 0:
+            self.pool.instances.pop(self.id, None)
+
+
+class WorkerProcess:
+    """The gateway's handle on a worker."""
+
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.process = None
+        self.conn = None
+        self.task = None
+        self.population = 0
+        self.alive = False
+
+    async def start(self):
+        if self.path.exists():
+            # Left behind by a worker that died
+            self.path.unlink()
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'darkworld.shards', str(self.path)
+        )
+        for _ in range(START_TIMEOUT * 10):
+            if self.path.exists():
+                break
+            await asyncio.sleep(0.1)
+        reader, writer = await asyncio.open_unix_connection(str(self.path))
+        self.conn = Connection(reader, writer)
+        self.alive = True
+
+
+class ShardPool:
+    """Start worker processes and route players to them."""
+
+    def __init__(self, max_instances=MAX_INSTANCES):
+        self.max_instances = max_instances
+        self.workers = []
+        self.instances = {}
+        self.sessions = {}
+        self.seq = itertools.count(1)
+        self.rng = random.Random()
+        self.tmpdir = None
+
+    async def start(self, n):
+        """Start n workers."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.workers = [
+            WorkerProcess(i, Path(self.tmpdir.name) / f'worker-{i}.sock')
+            for i in range(n)
+        ]
+        await asyncio.gather(*(w.start() for w in self.workers))
+        for w in self.workers:
+            w.task = asyncio.ensure_future(self.receive(w))
+        print(f'Started {n} dark world workers')
+
+    async def drain(self, timeout=5.0):
+        """Wait for the workers to hand back disconnected players."""
+        for _ in range(int(timeout * 10)):
+            if not self.sessions:
+                return
+            await asyncio.sleep(0.1)
+
+    def stop(self):
+        for w in self.workers:
+            if w.task:
+                w.task.cancel()
+            if w.conn:
+                w.conn.close()
+        self.workers = []
+        if self.tmpdir:
+            self.tmpdir.cleanup()
+            self.tmpdir = None
+
+    def get_dark_world(self, players=1):
+        """Get a dark world for a group of players to teleport to.
+
+        New instances go to the worker with the fewest players. Return None
+        if there are too many instances and none has room.
+
+        """
+        if len(self.instances) >= self.max_instances:
+            candidates = [
+                inst for inst in self.instances.values()
+                if inst.room >= players
+            ]
+            if not candidates:
+                return None
+            inst = max(candidates, key=lambda i: i.population + i.arriving)
+        elif not self.workers:
+            # They have all died, and are being replaced
+            return None
+        else:
+            worker = min(self.workers, key=lambda w: w.population)
+            inst = RemoteWorld(
+                self, worker, next(self.seq), self.rng.getrandbits(32)
+            )
+            self.instances[inst.id] = inst
+        inst.arriving += players
+        return inst
+
+    async def receive(self, worker):
+        """Handle messages from a worker, replacing it if it dies."""
+        while True:
+            msg = await worker.conn.recv()
+            if msg is None:
+                break
+            kind, *args = msg
+            try:
+                getattr(self, f'on_{kind}')(*args)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+        print(f'Lost dark world worker {worker.index}')
+        self.lost(worker)
+        await worker.process.wait()
+        await asyncio.sleep(RESTART_DELAY)
+        await self.restart(worker)
+
+    def lost(self, worker):
+        """Stop using a dead worker and rescue its players.
+
+        Players who are still connected respawn in the light world; the
+        rest are saved. Either way they get back what they had when they
+        teleported.
+
+        """
+        worker.alive = False
+        worker.conn.close()
+        self.workers.remove(worker)
+        for id, inst in list(self.instances.items()):
+            if inst.worker is worker:
+                del self.instances[id]
+        for name, c in list(self.sessions.items()):
+            if c.remote.worker is not worker:
+                continue
+            del self.sessions[name]
+            c.remote = None
+            if Client.clients.get(name) is c:
+                c.respawn(LOST_MSG, health=c.actor.health)
+            else:
+                c.save()
+
+    async def restart(self, worker):
+        """Start a worker to replace one that died."""
+        replacement = WorkerProcess(worker.index, worker.path)
+        try:
+            await replacement.start()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            print(f'Could not restart dark world worker {worker.index}')
+            return
+        self.workers.append(replacement)
+        replacement.task = asyncio.ensure_future(self.receive(replacement))
+        print(f'Restarted dark world worker {worker.index}')
+
+    def on_out(self, name, frame):
+        c = self.sessions.get(name)
+        if c:
+            c.outqueue.put_nowait(frame)
+
+    def on_left(self, name, state, msg):
+        c = self.sessions.pop(name, None)
+        if not c:
+            return
+        c.remote.left()
+        c.remote = None
+        c.set_state(state)
+        if Client.clients.get(name) is c:
+            c.respawn(msg, health=state['health'])
+        else:
+            # They disconnected while away
+            c.save()
+
+
+pool = ShardPool()
+
+
+if __name__ == '__main__':
+    worker_main(sys.argv[1])
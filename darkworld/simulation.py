@@ -0,0 +1,304 @@
+"""Simulate the game headlessly, faster than real time.
+
+Instead of running in real time, the ticker is stepped as fast as possible,
+and ticks in which nothing is due are skipped altogether, so that a day of
+world evolution passes in seconds or minutes. Players are in-process
+clients that take random actions; the messages sent to them are encoded and
+counted, then dropped.
+
+"""
+import asyncio
+import heapq
+import itertools
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from timeit import default_timer
+
+from . import metrics
+from . import persistence
+from .client import Client
+from .actor import Teleporter
+from .coords import Direction
+from .memory import MemoryReport
+from .scheduler import ticker
+from .world_gen import TELEPORTER_POS
+
+
+# The chance of each kind of action when a player acts
+ACTIONS = {
+    'north': 1,
+    'south': 1,
+    'east': 1,
+    'west': 1,
+    'act': 1,
+    'refresh': 0.1,
+    'teleport': 0.01,
+}
+
+# Seconds of simulated time between memory samples
+SAMPLE_INTERVAL = 3600
+
+# Mushrooms players are topped up to, to pay for teleporting
+MUSHROOMS = 100
+
+
+class HeadlessClient(Client):
+    """A client with no connection, that counts the frames sent to it."""
+
+    def __init__(self):
+        super().__init__(None)
+        self.frames = 0
+
+    def flush(self):
+        if self.pending:
+            self.pending = []
+            self.frames += 1
+
+
+class Player:
+    """A simulated player, taking random actions."""
+
+    def __init__(self, name, rng, actions=ACTIONS):
+        self.name = name
+        self.rng = rng
+        self.actions = list(actions)
+        self.weights = list(actions.values())
+        self.client = HeadlessClient()
+        self.teleports = 0
+
+    async def connect(self):
+        await self.client.handle_message({
+            'op': 'auth',
+            'name': self.name,
+            'token': f'sim-{self.name}',
+        })
+        self.client.grant('teleport')
+
+    async def act(self):
+        """Take a random action."""
+        actor = self.client.actor
+        if not actor.alive:
+            return
+        op = self.rng.choices(self.actions, self.weights)[0]
+        if op == 'teleport':
+            await self.teleport()
+        else:
+            await self.client.handle_message({'op': op})
+
+    async def teleport(self):
+        """Jump onto a teleporter and use it, rather than walking there."""
+        if self.board(TELEPORTER_POS[0]):
+            self.teleports += 1
+            await self.client.handle_message({'op': 'act'})
+
+    def board(self, pos):
+        """Jump onto the light world teleporter at pos, facing north.
+
+        Return False if the player is not in the light world or the
+        teleporter is occupied.
+
+        """
+        from .client import light_world
+        actor = self.client.actor
+        if actor.world is not light_world or \
+                not light_world.get(pos).standable:
+            return False
+        actor.kill()
+        actor.spawn(light_world, pos, Direction.NORTH)
+        self.client.sight.restart()
+        self.top_up()
+        return True
+
+    def top_up(self):
+        """Make sure the player has the mushrooms to pay for a teleport."""
+        inventory = self.client.inventory
+        missing = MUSHROOMS - inventory.count('mushroom')
+        if missing > 0:
+            inventory.add('mushroom', missing)
+
+    def go_home(self):
+        """Jump onto the teleporter home from a dark world.
+
+        Return False if the player is not in a dark world or the teleporter
+        is occupied.
+
+        """
+        from .client import light_world
+        actor = self.client.actor
+        world = actor.world
+        if world is light_world or not actor.alive:
+            return False
+        home = next(
+            obj for obj in world.by_uid.values()
+            if isinstance(obj, Teleporter)
+        )
+        if not world.get(home.pos).standable:
+            return False
+        actor.kill()
+        actor.spawn(world, home.pos)
+        self.client.sight.restart()
+        home.on_enter(actor)
+        return True
+
+
+def memory_sample():
+    """Summarise the memory in use."""
+    r = MemoryReport()
+    return {
+        'time': r.time,
+        'rss': r.rss,
+        'accounted': r.accounted,
+        'worlds': len(r.worlds),
+        'actors': sum(r.classes.values()),
+        'clients': len(r.clients),
+    }
+
+
+class Simulation:
+    """Run the worlds headlessly with simulated players.
+
+    Each player acts `rate` times per second of simulated time, on average.
+    The game is saved to `savedir`, a scratch directory by default; if it
+    holds a saved light world, the simulation starts from that.
+
+    """
+
+    def __init__(self, players=10, rate=0.2, seed=0, savedir=None,
+                 sample_interval=SAMPLE_INTERVAL, actions=ACTIONS):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.players = [
+            Player(f'sim_{i}_x', random.Random(self.rng.random()), actions)
+            for i in range(players)
+        ]
+        self.rate = rate
+        self.sample_interval = sample_interval
+        self.scratch = None
+        if savedir is None:
+            self.scratch = tempfile.TemporaryDirectory()
+            savedir = self.scratch.name
+        self.savedir = Path(savedir)
+        self.old_savedir = None
+        self.tick_times = []
+        self.skipped = 0
+        self.actions = 0
+        self.memory = []
+
+    def setup(self):
+        from . import ecosystem
+        self.old_savedir = persistence.savedir
+        persistence.savedir = self.savedir
+        random.seed(self.seed)
+        persistence.init_world()
+        ecosystem.setup_systems()
+
+    def next_action(self, player):
+        """Get the tick at which a player should next act."""
+        delay = self.rng.expovariate(self.rate)
+        return ticker.tick + ticker.to_ticks(delay)
+
+    async def start(self):
+        """Load the world and connect the players."""
+        from .instances import worlds
+
+        self.setup()
+        for p in self.players:
+            await p.connect()
+        self.sent = dict(metrics.messages_sent.values)
+        self.created = worlds.created
+        self.seq = itertools.count()
+        self.queue = [
+            (self.next_action(p), next(self.seq), p) for p in self.players
+        ]
+        heapq.heapify(self.queue)
+        self.start_tick = ticker.tick
+        self.next_sample = ticker.tick
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+
+    async def advance(self, seconds):
+        """Simulate the given number of seconds."""
+        queue = self.queue
+        end = ticker.tick + ticker.to_ticks(seconds)
+        while ticker.tick < end:
+            if ticker.tick >= self.next_sample:
+                self.memory.append(memory_sample())
+                self.next_sample += ticker.to_ticks(self.sample_interval)
+
+            due = min(queue[0][0] if queue else end, self.next_sample, end)
+            system_due = ticker.next_due()
+            if system_due is not None:
+                due = min(due, system_due)
+            if due > ticker.tick + 1:
+                self.skipped += due - 1 - ticker.tick
+                ticker.skip_to(due - 1)
+
+            t = default_timer()
+            ticker.step()
+            self.tick_times.append(default_timer() - t)
+
+            while queue and queue[0][0] <= ticker.tick:
+                _, _, p = heapq.heappop(queue)
+                await p.act()
+                self.actions += 1
+                heapq.heappush(queue, (self.next_action(p), next(self.seq), p))
+
+            # Let coroutines, such as NPCs talking, run
+            await asyncio.sleep(0)
+
+    def report(self):
+        """Report on the simulation so far."""
+        from .instances import worlds
+
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        simulated = (ticker.tick - self.start_tick) * ticker.timestep
+        times = sorted(self.tick_times)
+        return {
+            'simulated_seconds': simulated,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'speedup': simulated / wall,
+            'ticks_run': len(times),
+            'ticks_skipped': self.skipped,
+            'tick_ms': {
+                'mean': statistics.mean(times) * 1e3,
+                'p99': times[int(0.99 * (len(times) - 1))] * 1e3,
+                'max': times[-1] * 1e3,
+            },
+            'players': len(self.players),
+            'actions': self.actions,
+            'teleports': sum(p.teleports for p in self.players),
+            'dark_worlds_created': worlds.created - self.created,
+            'frames_sent': sum(p.client.frames for p in self.players),
+            'messages_sent': metrics.messages_sent.since(self.sent),
+            'memory': self.memory + [memory_sample()],
+        }
+
+    async def run(self, seconds):
+        """Simulate the given number of seconds, returning a report."""
+        await self.start()
+        await self.advance(seconds)
+        report = self.report()
+        for p in self.players:
+            p.client.close()
+        return report
+
+    def close(self):
+        if self.old_savedir:
+            persistence.savedir = self.old_savedir
+            self.old_savedir = None
+        if self.scratch:
+            self.scratch.cleanup()
+
+
+async def simulate(seconds, **kwargs):
+    """Simulate the game headlessly for `seconds`, returning a report."""
+    sim = Simulation(**kwargs)
+    try:
+        return await sim.run(seconds)
+    finally:
+        sim.close()
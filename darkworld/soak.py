@@ -0,0 +1,177 @@
+"""Check that dark worlds are freed after their players leave.
+
+A group of simulated players repeatedly teleports into a new dark world,
+wanders about for a while and goes home again. After each visit we collect
+garbage and check, through weak references, that the world and everything
+belonging to it - its AI, scheduler, chunks and enemies - has been freed.
+The resident size of the process is tracked across cycles, so that leaks
+which escape the weak references still show up as growth.
+
+"""
+import gc
+import weakref
+
+from .actor import Enemy
+from .memory import rss
+from .scheduler import ticker
+from .simulation import Simulation
+from .world_gen import TELEPORTER_POS
+
+
+# Players only walk about and act while soaking; teleports are scripted
+WANDER = {
+    'north': 1,
+    'south': 1,
+    'east': 1,
+    'west': 1,
+    'act': 1,
+}
+
+# Resident bytes the process may grow by after warming up
+MAX_GROWTH = 32 * 1024 * 1024
+
+# Seconds allowed for every player to get home
+HOME_TIMEOUT = 60
+
+# Enemies per world to watch
+WATCH_ENEMIES = 5
+
+
+def watch(world):
+    """Get (description, weakref) for a world and the things it owns."""
+    objs = [
+        ('world', world),
+        ('scheduler', world.scheduler),
+        ('ai', getattr(world, 'ai', None)),
+        ('chunks', world.chunks),
+    ]
+    enemies = [o for o in world.by_uid.values() if isinstance(o, Enemy)]
+    objs.extend(('Enemy', e) for e in enemies[:WATCH_ENEMIES])
+    return [(desc, weakref.ref(obj)) for desc, obj in objs if obj]
+
+
+def referrers(obj, limit=5):
+    """Describe some of the objects keeping obj alive."""
+    found = []
+    for r in gc.get_referrers(obj):
+        if type(r).__name__ == 'frame':
+            continue
+        found.append(f'{type(r).__name__}: {r!r:.100}')
+        if len(found) >= limit:
+            break
+    return found
+
+
+class Soak:
+    """Repeatedly send a group of players through dark worlds."""
+
+    def __init__(self, players=4, stay=60, seed=0, savedir=None,
+                 max_growth=MAX_GROWTH):
+        self.sim = Simulation(
+            players=min(players, len(TELEPORTER_POS)),
+            rate=1.0,
+            seed=seed,
+            savedir=savedir,
+            actions=WANDER,
+        )
+        self.stay = stay
+        self.max_growth = max_growth
+        self.leaks = []
+        self.rss = []
+        self.visits = 0
+
+    async def wait_until(self, predicate, timeout):
+        """Simulate until predicate() is true, or the timeout expires."""
+        for _ in range(timeout):
+            if predicate():
+                return True
+            await self.sim.advance(1)
+        return predicate()
+
+    def all_home(self):
+        from .client import light_world
+        players = self.sim.players
+        for p in players:
+            p.go_home()
+        return all(
+            p.client.actor.world is light_world and p.client.actor.alive
+            for p in players
+        )
+
+    async def visit(self):
+        """Send the players to a dark world and back.
+
+        Return weak references to what should be freed afterwards.
+
+        """
+        from .client import light_world
+        players = self.sim.players
+        if not await self.wait_until(self.all_home, HOME_TIMEOUT):
+            raise RuntimeError('Players did not make it home')
+        for p, pos in zip(players, TELEPORTER_POS):
+            p.board(pos)
+        await players[0].client.handle_message({'op': 'act'})
+        await self.sim.advance(2)
+
+        world = players[0].client.actor.world
+        if world is light_world:
+            raise RuntimeError('Players did not teleport')
+        self.visits += 1
+        refs = watch(world)
+        del world
+
+        await self.sim.advance(self.stay)
+        if not await self.wait_until(self.all_home, HOME_TIMEOUT):
+            raise RuntimeError('Players did not make it home')
+
+        # Give the world manager time to tear the world down
+        await self.sim.advance(5)
+        return refs
+
+    def check(self, cycle, refs):
+        """Record anything that should have been freed but was not."""
+        gc.collect()
+        for desc, ref in refs:
+            obj = ref()
+            if obj is not None:
+                self.leaks.append({
+                    'cycle': cycle,
+                    'object': desc,
+                    'referrers': referrers(obj),
+                })
+
+    async def run(self, cycles, progress=None):
+        """Run the soak test, returning a report."""
+        from .instances import worlds
+
+        await self.sim.start()
+        for cycle in range(cycles):
+            self.check(cycle, await self.visit())
+            self.rss.append(rss())
+            if progress:
+                progress(cycle, self.rss[-1], self.leaks)
+
+        warmup = len(self.rss) // 4
+        growth = self.rss[-1] - self.rss[warmup]
+        live = worlds.dark_instances()
+        return {
+            'cycles': cycles,
+            'visits': self.visits,
+            'simulated_seconds': ticker.time,
+            'leaks': self.leaks,
+            'live_instances': [inst.name for inst in live],
+            'rss': self.rss,
+            'growth': growth,
+            'passed': (
+                not self.leaks and not live and growth <= self.max_growth
+            ),
+        }
+
+
+async def soak(cycles, progress=None, **kwargs):
+    """Run a soak test, returning a report."""
+    s = Soak(**kwargs)
+    try:
+        return await s.run(cycles, progress)
+    finally:
+        s.sim.close()
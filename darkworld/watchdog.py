@@ -0,0 +1,156 @@
+"""Watch the event loop for lag and stalls.
+
+A coroutine wakes every INTERVAL seconds and records how late it woke up;
+that lateness is the loop lag, the delay any callback would see before
+running. Each wake-up is also a heartbeat. A helper thread checks the
+heartbeat, and if the loop has been stuck in one callback for longer than
+STALL_THRESHOLD it captures the loop thread's Python stack, so that the
+code responsible can be found afterwards.
+
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from . import metrics
+
+
+# Seconds between heartbeats
+INTERVAL = 0.1
+
+# Seconds a callback may block the loop before it is reported as a stall
+STALL_THRESHOLD = 0.25
+
+# Number of lag samples to compute percentiles over (one minute's worth)
+LAG_SAMPLES = 600
+
+# Number of recent stalls to keep
+STALL_HISTORY = 20
+
+
+class Stall:
+    """A period in which the event loop was blocked."""
+
+    def __init__(self, beat, task, stack):
+        self.beat = beat
+        self.time = time.time()
+        self.task = task
+        self.stack = stack
+        self.duration = None
+
+    def format(self):
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.time))
+        if self.duration is None:
+            duration = 'still blocked'
+        else:
+            duration = f'blocked for {self.duration:.3f}s'
+        return f'{when} {duration} in {self.task}\n{self.stack}'
+
+
+class Watchdog:
+    """Measure event loop lag and capture the stacks of stalls."""
+
+    def __init__(self, interval=INTERVAL, threshold=STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = deque(maxlen=LAG_SAMPLES)
+        self.stalls = deque(maxlen=STALL_HISTORY)
+        self.heartbeat = None
+        self.loop = None
+        self.loop_thread = None
+        self.task = None
+        self.thread = None
+
+    def start(self):
+        """Start watching the current event loop."""
+        if self.task:
+            return
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.ensure_future(self.run())
+        self.thread = threading.Thread(
+            target=self.watch,
+            name='watchdog',
+            daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        """Record the lag of each heartbeat."""
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                lag = max(0.0, now - expected)
+                self.lags.append(lag)
+                metrics.loop_lag_seconds.observe(lag)
+
+                stall = self.stalls[-1] if self.stalls else None
+                if stall and stall.beat == self.heartbeat:
+                    stall.duration = lag
+                self.heartbeat = now
+        except asyncio.CancelledError:
+            return
+
+    def watch(self):
+        """Check the heartbeat from another thread, until stopped."""
+        while self.task:
+            time.sleep(self.threshold / 2)
+            beat = self.heartbeat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold:
+                continue
+            if self.stalls and self.stalls[-1].beat == beat:
+                continue
+            self.capture(beat, blocked)
+
+    def capture(self, beat, blocked):
+        """Record the stack of the code that is blocking the loop."""
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        task = asyncio.current_task(self.loop)
+        name = repr(task) if task else 'a callback'
+        self.stalls.append(Stall(beat, name, stack))
+        metrics.loop_stalls.inc()
+        print(f'Event loop blocked for over {blocked:.2f}s in {name}')
+
+    def percentiles(self, quantiles=(0.5, 0.9, 0.99)):
+        """Get percentiles of the recent loop lag."""
+        lags = sorted(self.lags)
+        if not lags:
+            return {}
+        return {
+            (str(q),): lags[min(len(lags) - 1, int(q * len(lags)))]
+            for q in quantiles
+        }
+
+    def report(self):
+        """Describe the recent lag and stalls, most recent first."""
+        lines = ['Loop lag over the last minute:']
+        for (q,), lag in self.percentiles().items():
+            lines.append(f'  p{float(q) * 100:g}: {lag * 1000:.1f}ms')
+        lines.append(f'{len(self.stalls)} recent stalls')
+        for stall in reversed(self.stalls):
+            lines.append('')
+            lines.append(stall.format())
+        return '\n'.join(lines)
+
+
+watchdog = Watchdog()
+
+metrics.Gauge(
+    'darkworld_loop_lag_recent_seconds',
+    'Percentiles of event loop lag over the last minute.',
+    ('quantile',),
+    func=watchdog.percentiles
+)
@@ -1,8 +1,12 @@
 import random
 import weakref
 import traceback
+from collections import Counter
+from timeit import default_timer
 
 from .coords import Rect
+from .scheduler import ticker
+from . import metrics
 
 
 class Collision(Exception):
@@ -20,11 +24,13 @@ class World:
             size,
             accessible_area=None,
             foliage_area=None,
-            metadata=None):
+            metadata=None,
+            seed=None):
         self.grid = {}
         self.by_uid = {}
         self.metadata = metadata or {}
         self.subscriptions = weakref.WeakSet()
+        self.scheduler = ticker.new_scheduler(self.metadata.get('title'))
 
         # Really defines the spawn area
         self.size = size
@@ -32,6 +38,16 @@ class World:
         self.accessible_area = accessible_area
         self.foliage_area = list(foliage_area) if foliage_area else None
 
+        # Random numbers for things that happen in this world
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        # Static navigation data, for worlds whose walls never move
+        self.nav = None
+
+        # Contents created on demand as parts of the world are revealed
+        self.chunks = None
+
     def __repr__(self):
         return f"<World {self.metadata['title']}>"
 
@@ -73,6 +89,16 @@ class World:
         """Get the object at the given coordinates."""
         return self.grid.get(pos)
 
+    def reveal(self, rect):
+        """Ensure that everything within rect has been created.
+
+        Call this before looking at a part of the world that may not have
+        been seen before.
+
+        """
+        if self.chunks:
+            self.chunks.reveal(self, rect)
+
     def spawn(self, obj, pos=None, effect=None):
         """Spawn an object into the grid."""
         if obj.uid in self.by_uid:
@@ -142,6 +168,8 @@ class World:
         """Move the object in the grid."""
         from_pos = obj.pos
         below = obj.below
+        if self.chunks:
+            self.chunks.reveal_pos(self, to_pos)
         if to_pos == from_pos:
             self.get_subscribers(from_pos).move(obj, from_pos, from_pos)
             return
@@ -195,9 +223,10 @@ class World:
     def __getstate__(self):
         grid = {}
         for pos, obj in self.grid.items():
-            while not obj.serialisable:
+            while obj and not obj.serialisable:
                 obj = obj.below
-            grid[pos] = obj
+            if obj:
+                grid[pos] = obj
 
         return (
             grid,
@@ -217,6 +246,11 @@ class World:
         ) = state
         self.by_uid = {}
         self.subscriptions = weakref.WeakSet()
+        self.scheduler = ticker.new_scheduler(self.metadata.get('title'))
+        self.nav = None
+        self.chunks = None
+        self.seed = None
+        self.rng = random.Random()
         for pos, obj in self.grid.items():
             while True:
                 self.by_uid[obj.uid] = obj
@@ -232,13 +266,32 @@ class SubscriberSet(set):
     This allows dispatching events to each subscriber.
     """
     def dispatcher(target):
-        """Construct a method for dispatching to all subscribers in the set."""
+        """Construct a method for dispatching to all subscribers in the set.
+
+        The time taken by the whole dispatch is recorded, labelled with the
+        event; this is the hottest path in the game, so subscribers are not
+        timed individually. Slow dispatches are logged with the classes of
+        the subscribers.
+
+        """
         def method(self, *args):
+            start = default_timer()
             for subscriber in self:
                 try:
                     getattr(subscriber, target)(*args)
                 except Exception:
                     traceback.print_exc()
+            elapsed = default_timer() - start
+            metrics.latency['event'].observe(elapsed, target)
+            if elapsed > metrics.SLOW_THRESHOLD:
+                classes = Counter(type(s).__name__ for s in self)
+                metrics.log_slow(
+                    'event', target, elapsed,
+                    obj=args[0],
+                    subscribers=','.join(
+                        f'{name}x{n}' for name, n in classes.most_common()
+                    )
+                )
         method.__name__ = f'dispatch_{target}'
         return method
 
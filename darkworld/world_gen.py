@@ -1,32 +1,56 @@
+import hashlib
 import random
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 from contextlib import contextmanager
 from timeit import default_timer
 from itertools import product
 
+import numpy as np
 from PIL import Image
 
-from .coords import Direction, adjacent, random_dir, border
-from .world import World, Collision
+from .coords import Direction, DIRECTION_MAP, random_dir
+from .world import World, Collision, Subscriber
 from .actor import (
-    Teleporter, Trigger, Large, Block,
+    Teleporter, Trigger, Large, Block, Enemy,
     Chest, Bush, Plant, Tree, Mushroom
 )
-from .enemies import random_enemy
-from .ai import EnemyAI
+from .enemies import ENEMIES
+from .ai import create_ai, All
+from .navigation import NavGrid
+from . import metrics
 from .npcs import spawn_npcs
 
 
-def erode(grid):
-    for pos in list(grid):
-        for d in Direction:
-            grid.add(adjacent(pos, d))
+# Neighbour offsets in the order of the Direction values
+DELTAS = np.array([DIRECTION_MAP[d] for d in sorted(Direction)])
 
+# Empty cells kept around the generated map, so that shifting masks by the
+# few cells we look at never wraps anything around
+PAD = 4
 
-def stochastic_erode(grid, prob=0.1):
-    for pos in list(grid):
-        for d in Direction:
-            if random.random() <= prob:
-                grid.add(adjacent(pos, d))
+
+def shift(mask, dx, dy):
+    """Get a mask of whether the cell at (x + dx, y + dy) is set in mask."""
+    return np.roll(mask, (-dy, -dx), axis=(0, 1))
+
+
+def erode(mask):
+    """Grow the set cells of mask into all their neighbours."""
+    out = mask.copy()
+    for dx, dy in DELTAS:
+        out |= shift(mask, dx, dy)
+    return out
+
+
+def stochastic_erode(mask, prob=0.1, rng=None):
+    """Grow the set cells of mask into each neighbour with probability prob."""
+    rng = rng or np.random.default_rng()
+    out = mask.copy()
+    for dx, dy in DELTAS:
+        grow = mask & (rng.random(mask.shape) <= prob)
+        out |= shift(grow, -dx, -dy)
+    return out
 
 
 @contextmanager
@@ -35,32 +59,273 @@ def timeit(msg):
     yield
     end = default_timer()
     print(f'{msg}: {end - start:.2}s')
+    metrics.worldgen_seconds.observe(end - start, msg)
+
+
+# Wall models, keyed by whether there are walls at each of the cells in REL
+BLOCK_MAP = {
+    (1, 1, 1): ('nature/cliffGrey_block', 1),
+    (1, 0, 1): ('nature/cliffGrey_cornerInnerTop', 1),
+    (0, 0, 1): ('nature/cliffGrey_top_2', 1),
+    (0, 1, 0): ('nature/cliffGrey_cornerTop', 1),
+    (0, 0, 0): ('nature/cliffGrey_cornerTop', 1),
+}
+
+REL = [
+    (Direction.NORTH, [
+        (0, -1),
+        (1, -1),
+        (1, 0),
+    ]),
+    (Direction.EAST, [
+        (1, 0),
+        (1, 1),
+        (0, 1),
+    ]),
+    (Direction.SOUTH, [
+        (0, 1),
+        (-1, 1),
+        (-1, 0),
+    ]),
+    (Direction.WEST, [
+        (-1, 0),
+        (-1, -1),
+        (0, -1),
+    ])
+]
+
+# The distinct wall models, and an array mapping the neighbour code of a wall
+# cell to its index in BLOCK_MODELS, or -1 if it gets no block
+BLOCK_MODELS = sorted(set(BLOCK_MAP.values()))
+BLOCK_TABLE = np.array([
+    BLOCK_MODELS.index(BLOCK_MAP[key]) if key in BLOCK_MAP else -1
+    for key in product((0, 1), repeat=3)
+])
+
+
+DarkLayout = namedtuple('DarkLayout', 'seed blocks chests enemies nav')
+
+
+def random_walks(rng, walks, min_steps, max_steps):
+    """Generate some random walks from the origin, all at once.
+
+    Return an array of every position visited and an array of the end points
+    of the walks.
+
+    """
+    lengths = rng.integers(min_steps, max_steps + 1, size=walks)
+    ends = np.cumsum(lengths)
+    deltas = DELTAS[rng.integers(len(DELTAS), size=ends[-1])]
+    positions = np.cumsum(deltas, axis=0)
+    # Each walk restarts from the origin, so subtract the position reached
+    # by the end of the walk before
+    restart = np.repeat(ends - lengths, lengths)
+    positions -= np.vstack([[0, 0], positions])[restart]
+    return positions, positions[ends - 1]
+
+
+def generate_dark_layout(seed, walks=(3, 6), steps=(100, 200)):
+    """Generate the layout of a dark world from a seed.
+
+    This does all the expensive work of generating a dark world but creates
+    no actors, so that it can run in a worker process. Cells are handled as
+    boolean masks indexed by [y - y0, x - x0].
+
+    `walks` and `steps` give the ranges for the number of random walks and
+    the number of steps in each.
+
+    """
+    rng = np.random.default_rng(seed)
 
+    with timeit('walk'):
+        positions, end_points = random_walks(
+            rng,
+            rng.integers(walks[0], walks[1] + 1),
+            *steps
+        )
+        x0, y0 = np.minimum(positions.min(axis=0), -1) - PAD
+        x1, y1 = np.maximum(positions.max(axis=0), 1) + PAD
+        floor = np.zeros((y1 - y0 + 1, x1 - x0 + 1), dtype=bool)
+        floor[positions[:, 1] - y0, positions[:, 0] - x0] = True
+        floor[-y0, -x0] = True
 
-def create_dark_world():
-    """Create an instance of a dark world."""
+    with timeit('stochastic'):
+        floor = stochastic_erode(floor, rng=rng)
 
-    end_points = set()
+    # Entrance
+    entrance = np.zeros_like(floor)
+    entrance[-y0 - 1:-y0 + 2, -x0 - 1:-x0 + 2] = True
+    floor |= entrance
 
-    with timeit('walk'):
-        logical_grid = {(0, 0)}
-        for i in range(random.randint(3, 6)):
-            pos = (0, 0)
-            last_dir = None
-            for step in range(random.randint(100, 200)):
-                dir = last_dir
-                while dir is last_dir:
-                    dir = random_dir()
-                pos = adjacent(pos, dir)
-                logical_grid.add(pos)
-
-            end_points.add(pos)
-
-#    with timeit('erode'):
-#        erode(logical_grid)
-    with timeit('stochastic'):
-        stochastic_erode(logical_grid)
+    with timeit('border'):
+        walls = erode(floor) & ~floor
+        walls = erode(walls) & ~floor
+
+        # Neighbour codes of every wall cell, for each direction
+        ys, xs = np.nonzero(walls)
+        codes = np.zeros((len(REL), len(xs)), dtype=np.int8)
+        for d, (dir, rels) in enumerate(REL):
+            for rx, ry in rels:
+                codes[d] = codes[d] * 2 + walls[ys + ry, xs + rx]
+        tiles = BLOCK_TABLE[codes]
+        ds, cells = np.nonzero(tiles >= 0)
+
+        dirs = [dir for dir, rels in REL]
+        xs = (xs + x0).tolist()
+        ys = (ys + y0).tolist()
+        blocks = [
+            ((xs[i], ys[i]), dirs[d], *BLOCK_MODELS[t])
+            for d, i, t in zip(
+                ds.tolist(), cells.tolist(), tiles[ds, cells].tolist()
+            )
+        ]
+
+    with timeit('nav'):
+        nav = NavGrid.from_mask(walls, x0, y0)
+
+    ends = np.zeros_like(floor)
+    ends[end_points[:, 1] - y0, end_points[:, 0] - x0] = True
+    chests = [
+        ((int(x + x0), int(y + y0)), Direction(d))
+        for y, x, d in zip(
+            *np.nonzero(ends),
+            rng.integers(len(DELTAS), size=ends.sum())
+        )
+    ]
 
+    ys, xs = np.nonzero(floor & ~entrance & ~ends)
+    chosen = rng.choice(len(xs), size=len(xs) // 20, replace=False)
+    enemies = [
+        ((int(xs[i] + x0), int(ys[i] + y0)), ENEMIES[k])
+        for i, k in zip(chosen, rng.integers(len(ENEMIES), size=len(chosen)))
+    ]
+    return DarkLayout(seed, blocks, chests, enemies, nav)
+
+
+class DarkWorldChanges(Subscriber):
+    """Record what players change in a dark world.
+
+    A dark world is fully described by its seed plus these changes - which
+    chests have been opened and which enemies killed, by their index in the
+    layout - so it can be saved or shared in a few bytes and rebuilt with
+    restore_dark_world().
+
+    """
+    def __init__(self, world, opened=(), killed=()):
+        super().__init__(All(), world)
+        self.seed = world.seed
+        self.chests = {}
+        self.enemies = {}
+        self.opened = set(opened)
+        self.dead = set(killed)
+
+    def killed(self, obj, pos, effect):
+        if obj.uid in self.chests:
+            self.opened.add(self.chests[obj.uid])
+        elif obj.uid in self.enemies:
+            self.dead.add(self.enemies[obj.uid])
+
+    def describe(self):
+        """Get a description of the world that can be restored later."""
+        return {
+            'seed': self.seed,
+            'opened': sorted(self.opened),
+            'killed': sorted(self.dead),
+        }
+
+
+# Width and height of the chunks in which dark worlds are created
+CHUNK_SIZE = 16
+
+
+class Chunk:
+    """The actors of a layout that lie within one chunk, not yet created."""
+
+    def __init__(self):
+        self.blocks = []
+        self.chests = []
+        self.enemies = []
+
+
+class LazyChunks:
+    """Create the actors of a dark world layout a chunk at a time.
+
+    Walls, chests and enemies are only created when a chunk is first
+    revealed - seen by a player or entered by anything - so the cost of an
+    instance depends on how much of it is explored. The layout's NavGrid
+    already covers every wall, so paths never lead through unrevealed ones.
+
+    """
+    def __init__(self, layout, changes):
+        self.changes = changes
+        self.pending = {}
+        for block in layout.blocks:
+            self._chunk(block[0]).blocks.append(block)
+        for i, (pos, dir) in enumerate(layout.chests):
+            if i not in changes.opened:
+                self._chunk(pos).chests.append((i, pos, dir))
+        for i, (pos, spec) in enumerate(layout.enemies):
+            if i not in changes.dead:
+                self._chunk(pos).enemies.append((i, pos, spec))
+
+    def _chunk(self, pos):
+        key = pos[0] // CHUNK_SIZE, pos[1] // CHUNK_SIZE
+        chunk = self.pending.get(key)
+        if chunk is None:
+            chunk = self.pending[key] = Chunk()
+        return chunk
+
+    def reveal(self, world, rect):
+        """Create the contents of all chunks overlapping rect."""
+        if not self.pending:
+            return
+        for cx in range(rect.x1 // CHUNK_SIZE, rect.x2 // CHUNK_SIZE + 1):
+            for cy in range(rect.y1 // CHUNK_SIZE, rect.y2 // CHUNK_SIZE + 1):
+                chunk = self.pending.pop((cx, cy), None)
+                if chunk:
+                    self.create(world, chunk)
+
+    def reveal_pos(self, world, pos):
+        """Create the contents of the chunk containing pos."""
+        key = pos[0] // CHUNK_SIZE, pos[1] // CHUNK_SIZE
+        chunk = self.pending.pop(key, None)
+        if chunk:
+            self.create(world, chunk)
+
+    def create(self, world, chunk):
+        """Create the actors in a chunk."""
+        for p, dir, model, scale in chunk.blocks:
+            block = Block(model, scale=scale)
+            block.direction = dir
+            block.pos = p
+            block.world = world
+            world._push(block, p, force=True)
+            world.by_uid[block.uid] = block
+
+        for i, pos, dir in chunk.chests:
+            try:
+                chest = Chest().spawn(world, pos, direction=dir)
+            except Collision:
+                continue
+            self.changes.chests[chest.uid] = i
+
+        for i, pos, spec in chunk.enemies:
+            enemy = Enemy(*spec)
+            try:
+                enemy.spawn(world, pos)
+            except Collision:
+                continue
+            self.changes.enemies[enemy.uid] = i
+
+
+def build_dark_world(layout, opened=(), killed=()):
+    """Create a dark world from a layout.
+
+    Only the teleporter home is created up front; everything else is created
+    as it is revealed. Chests in `opened` and enemies in `killed`, given by
+    index, are left out.
+
+    """
     w = World(
         size=10,
         metadata={
@@ -73,134 +338,194 @@ def create_dark_world():
             'world_tex': 'dark_terrain',
         },
         # accessible_area=set(logical_grid),
+        seed=layout.seed,
     )
-
-    # Entrance
-    entrance = set(product((-1, 0, 1), (-1, 0, 1)))
-    logical_grid.update(entrance)
-
-    BLOCK_MAP = {
-            (1, 1, 1): ('nature/cliffGrey_block', 1),
-            (1, 0, 1): ('nature/cliffGrey_cornerInnerTop', 1),
-            (0, 0, 1): ('nature/cliffGrey_top_2', 1),
-            (0, 1, 0): ('nature/cliffGrey_cornerTop', 1),
-            (0, 0, 0): ('nature/cliffGrey_cornerTop', 1),
-    }
-
-    rel = [
-        (Direction.NORTH, [
-            (0, -1),
-            (1, -1),
-            (1, 0),
-        ]),
-        (Direction.EAST, [
-            (1, 0),
-            (1, 1),
-            (0, 1),
-        ]),
-        (Direction.SOUTH, [
-            (0, 1),
-            (-1, 1),
-            (-1, 0),
-        ]),
-        (Direction.WEST, [
-            (-1, 0),
-            (-1, -1),
-            (0, -1),
-        ])
-    ]
-
-    with timeit('border'):
-        walls = border(logical_grid)
-        walls.update(border(walls) - logical_grid)
-        for p in walls:
-            px, py = p
-            for dir, rels in rel:
-                adj = tuple((px + rx, py + ry) in walls for rx, ry in rels)
-                ms = BLOCK_MAP.get(adj)
-                if not ms:
-                    continue
-                model, scale = ms
-
-                block = Block(model, scale=scale)
-                block.direction = dir
-                block.pos = p
-                block.world = w
-                w._push(block, p, force=True)
-                w.by_uid[block.uid] = block
+    w.nav = layout.nav
 
     from . import client
     Teleporter(target=client.light_world).spawn(w, (0, 0))
 
-    logical_grid.difference_update(entrance)
+    w.changes = DarkWorldChanges(w, opened, killed)
+    w.subscribe(w.changes)
+    w.ai = create_ai([], seed=layout.seed, size=len(layout.enemies))
+    w.ai.attach(w)
+    w.chunks = LazyChunks(layout, w.changes)
+    return w
 
-    for e in end_points:
-        try:
-            Chest().spawn(w, e, direction=random_dir())
-        except Collision:
-            pass
-        else:
-            logical_grid.discard(e)
 
-    enemy_pos = random.sample(list(logical_grid), len(logical_grid) // 20)
+def create_dark_world(seed=None):
+    """Create an instance of a dark world.
 
-    enemies = []
-    for pos in enemy_pos:
-        logical_grid.discard(pos)
-        e = random_enemy()
-        e.spawn(w, pos)
-        enemies.append(e)
+    The same seed always generates the same world.
 
-    w.ai = EnemyAI(enemies)
-    w.subscribe(w.ai)
-    return w
+    """
+    if seed is None:
+        seed = random.getrandbits(32)
+    return build_dark_world(generate_dark_layout(seed))
+
+
+def restore_dark_world(description):
+    """Rebuild a dark world from DarkWorldChanges.describe()."""
+    return build_dark_world(
+        generate_dark_layout(description['seed']),
+        opened=set(description['opened']),
+        killed=set(description['killed']),
+    )
+
+
+def load_heightmap(filename, size, thresholds=(45,)):
+    """Load the regions of the given heightmap above each threshold.
 
+    Return a boolean mask per threshold, indexed by [y + size, x + size].
 
-def load_heightmap(filename, size, threshold=45):
-    """Load accessible regions from the given heightmap."""
+    """
     heightmap = Image.open(filename)
     heightmap = heightmap.resize(
         (2 * size + 1,) * 2,
     )
+    heights = np.asarray(heightmap)
+    return [heights > t for t in thresholds]
+
+
+def reachable(mask, start):
+    """Find the cells of mask connected to the cell at index start.
+
+    `start` is a (row, column) index into mask. The mask is broken into
+    horizontal runs of set cells, and the search joins runs that overlap in
+    adjacent rows, so it visits each run rather than each cell.
+
+    """
+    rows = mask.shape[0]
+    edges = np.diff(mask.astype(np.int8), axis=1, prepend=0, append=0)
+    run_rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    row_start = np.searchsorted(run_rows, np.arange(rows + 1)).tolist()
+    starts_list = starts.tolist()
+    ends_list = ends.tolist()
+
+    out = np.zeros_like(mask)
+    y, x = start
+    if not mask[y, x]:
+        return out
+    first = bisect_right(starts_list, x, row_start[y], row_start[y + 1]) - 1
+
+    seen = {first}
+    edge = [first]
+    while edge:
+        r = edge.pop()
+        y = run_rows[r]
+        a = starts_list[r]
+        b = ends_list[r]
+        for ny in (y - 1, y + 1):
+            if not 0 <= ny < rows:
+                continue
+            lo = row_start[ny]
+            hi = row_start[ny + 1]
+            # Runs in row ny with start < b and end > a overlap this one
+            i = bisect_right(ends_list, a, lo, hi)
+            j = bisect_left(starts_list, b, lo, hi)
+            for n in range(i, j):
+                if n not in seen:
+                    seen.add(n)
+                    edge.append(n)
 
-    area = set()
-    for x in range(-size, size + 1):
-        for y in range(-size, size + 1):
-            p = (x + size, y + size)
-            h = heightmap.getpixel(p)
-            if h > threshold:
-                area.add((x, y))
+    found = np.fromiter(seen, dtype=np.intp, count=len(seen))
+    fill = np.zeros((mask.shape[0], mask.shape[1] + 1), dtype=np.int8)
+    fill[run_rows[found], starts[found]] += 1
+    fill[run_rows[found], ends[found]] -= 1
+    out[:] = fill.cumsum(axis=1)[:, :-1] > 0
+    return out
 
-    return area
 
+def mask_cells(mask, size):
+    """Get the set of coordinates of a mask indexed by [y + size, x + size]."""
+    ys, xs = np.nonzero(mask)
+    return set(zip((xs - size).tolist(), (ys - size).tolist()))
 
-def reachable(area, pos):
-    """Find the area reachable from a given set of coordinates."""
-    reachable = {pos, }
-    edge = {pos, }
-    while edge:
-        pos = edge.pop()
-        for d in Direction:
-            p = adjacent(pos, d)
-            if p not in area:
-                continue
-            if p in reachable:
-                continue
-            reachable.add(p)
-            edge.add(p)
-    return reachable
 
+# The light world spans this many cells either side of the origin
+LIGHT_WORLD_SIZE = 320
 
-def create_light_world():
-    SIZE = 320
+HEIGHTMAP = 'assets/heightmap.png'
 
-    world_area = reachable(
-        area=load_heightmap('assets/heightmap.png', SIZE),
-        pos=(0, 0)
-    )
-    plant_areas = load_heightmap('assets/heightmap.png', SIZE, 55) & world_area
+# Heights above which cells are accessible, and grow foliage
+THRESHOLDS = (45, 55)
+
+# Bump this when changing the fixed layout, to invalidate cached terrain
+TERRAIN_VERSION = 1
+
+TRIGGER_POS = (2, -14)
+
+TELEPORTER_POS = [
+    (2, -13),
+    (2, -15),
+    (1, -14),
+    (3, -14),
+]
+
+
+# The parts of the light world derived from the heightmap. accessible is a
+# set of coordinates; foliage is a list of the accessible coordinates where
+# plants may grow, excluding the fixed layout.
+Terrain = namedtuple('Terrain', 'accessible foliage')
+
+
+def terrain_key():
+    """Get a hash of everything the light world terrain is derived from."""
+    h = hashlib.sha256()
+    with open(HEIGHTMAP, 'rb') as f:
+        h.update(f.read())
+    params = (LIGHT_WORLD_SIZE, THRESHOLDS, TERRAIN_VERSION)
+    h.update(repr(params).encode('ascii'))
+    return h.hexdigest()
+
+
+def spawn_fixed_layout(world):
+    """Spawn the hand-placed actors of the light world.
+
+    Return the set of cells they occupy.
+
+    """
+    occupied = set()
+    trigger = Trigger('nature/stone_obelisk').spawn(world, TRIGGER_POS)
+    occupied.add(TRIGGER_POS)
+
+    tent = Large('nature/tent_detailedOpen', (2, 2))
+    tent.spawn(world, (-14, 0), Direction.SOUTH)
+    occupied.update(tent.bounds().coords())
+
+    for npc in spawn_npcs(world):
+        if isinstance(npc, Large):
+            occupied.update(npc.bounds().coords())
+        else:
+            occupied.add(npc.pos)
+
+    for p in TELEPORTER_POS:
+        occupied.add(p)
+        Teleporter(trigger=trigger).spawn(world, p)
+    return occupied
+
+
+def generate_terrain():
+    """Derive the light world terrain from the heightmap."""
+    size = LIGHT_WORLD_SIZE
+    with timeit('heightmap'):
+        accessible, foliage = load_heightmap(HEIGHTMAP, size, THRESHOLDS)
+    with timeit('reachable'):
+        world_mask = reachable(accessible, (size, size))
+    world_area = mask_cells(world_mask, size)
+    plant_areas = mask_cells(foliage & world_mask, size)
+
+    scratch = World(size=size, accessible_area=world_area)
+    plant_areas.difference_update(spawn_fixed_layout(scratch))
+    return Terrain(world_area, sorted(plant_areas))
+
+
+def create_light_world(terrain=None):
+    terrain = terrain or generate_terrain()
+    plant_areas = set(terrain.foliage)
     light_world = World(
-        size=SIZE,
+        size=LIGHT_WORLD_SIZE,
         metadata={
             'title': 'The Light World',
             'title_color': 'black',
@@ -209,31 +534,10 @@ def create_light_world():
             'ambient_color': 0xffffff,
             'ambient_intensity': 0.2
         },
-        accessible_area=world_area,
-        foliage_area=plant_areas,
+        accessible_area=set(terrain.accessible),
+        foliage_area=terrain.foliage,
     )
-
-    TELEPORTER_POS = [
-        (2, -13),
-        (2, -15),
-        (1, -14),
-        (3, -14),
-    ]
-
-    trigger_pos = (2, -14)
-    trigger = Trigger('nature/stone_obelisk').spawn(light_world, trigger_pos)
-    plant_areas.discard(trigger_pos)
-
-    tent = Large('nature/tent_detailedOpen', (2, 2))
-    tent.spawn(light_world, (-14, 0), Direction.SOUTH)
-    plant_areas.difference_update(tent.bounds().coords())
-
-    for npc in spawn_npcs(light_world):
-        plant_areas.discard(npc.pos)
-
-    for p in TELEPORTER_POS:
-        plant_areas.discard(p)
-        Teleporter(trigger=trigger).spawn(light_world, p)
+    spawn_fixed_layout(light_world)
 
     # Insert a bat for testing
     # Enemy('enemies/bat', 10).spawn(light_world, (1, 1))
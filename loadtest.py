@@ -0,0 +1,371 @@
+"""Generate load on a running server with a swarm of bots.
+
+Start the server with DARKWORLD_LOADTEST set, so that bots can use the
+teleporters and are not saved, then run, say::
+
+    $ DARKWORLD_LOADTEST=1 python run_server.py
+    $ python loadtest.py --bots 100 --duration 60
+
+Each bot authenticates, then random-walks, acts, chats and opens its
+inventory at the given rates. Some bots walk to the teleporters and go to
+the dark world. At the end we report how long the server took to echo each
+action back to the bot, the rate of messages received and how many bots
+were disconnected.
+
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict, deque
+
+import aiohttp
+import click
+
+from darkworld.world_gen import TELEPORTER_POS
+
+
+# Seconds after which an action that has not been echoed is counted as lost
+ECHO_TIMEOUT = 10.0
+
+# Actions that the server echoes back to the bot, so we can time them
+ECHOED = {'move', 'say', 'inventory', 'refresh'}
+
+DIRECTIONS = {
+    'north': (0, -1),
+    'south': (0, 1),
+    'east': (1, 0),
+    'west': (-1, 0),
+}
+
+# Server metrics to compare before and after the run
+SERVER_METRICS = [
+    ('darkworld_tick_overruns', 'tick overruns'),
+    ('darkworld_ticks_dropped', 'ticks dropped'),
+    ('darkworld_loop_stalls_total', 'event loop stalls'),
+]
+
+
+class Stats:
+    """Statistics gathered across all bots."""
+
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.sent = Counter()
+        self.lost = Counter()
+        self.received = Counter()
+        self.frames = 0
+        self.bytes = 0
+        self.connected = 0
+        self.failed = 0
+        self.authfails = 0
+        self.disconnects = 0
+        self.teleports = 0
+
+
+class Bot:
+    """A simulated player."""
+
+    def __init__(self, name, stats, rates, rng, teleporter=False):
+        self.name = name
+        self.token = f'loadtest-{name}'
+        self.stats = stats
+        self.rates = rates
+        self.rng = rng
+        self.teleporter = teleporter
+        self.ws = None
+        self.pending = defaultdict(deque)
+        self.pos = None
+        self.world = None
+        self.busy_until = 0
+        self.closing = False
+
+    async def run(self, session, url, until):
+        """Play until the given time on the monotonic clock."""
+        try:
+            self.ws = await session.ws_connect(url)
+        except aiohttp.ClientError:
+            self.stats.failed += 1
+            return
+        self.stats.connected += 1
+        reader = asyncio.ensure_future(self.read())
+        try:
+            await self.send('auth', name=self.name, token=self.token)
+            await self.play(until, reader)
+        finally:
+            self.closing = True
+            await self.ws.close()
+            await reader
+
+    async def send(self, op, **msg):
+        self.stats.sent[op] += 1
+        if op in DIRECTIONS:
+            action = 'move'
+        else:
+            action = op
+        if action in ECHOED:
+            self.pending[action].append(time.monotonic())
+        await self.ws.send_str(json.dumps({'op': op, **msg}))
+
+    def expire(self):
+        """Count actions that have gone unanswered for too long as lost."""
+        limit = time.monotonic() - ECHO_TIMEOUT
+        for action, times in self.pending.items():
+            while times and times[0] < limit:
+                times.popleft()
+                self.stats.lost[action] += 1
+
+    async def play(self, until, reader):
+        actions = list(self.rates)
+        weights = [self.rates[a] for a in actions]
+        total = sum(weights)
+        while not reader.done():
+            await asyncio.sleep(self.rng.expovariate(total))
+            now = time.monotonic()
+            if now >= until:
+                return
+            self.expire()
+            if self.pos is None or now < self.busy_until:
+                continue
+            action = self.rng.choices(actions, weights)[0]
+            if action == 'move':
+                await self.send(self.choose_step())
+            elif action == 'act':
+                await self.act()
+            elif action == 'say':
+                await self.send('say', msg=f'Hello from {self.name}')
+            else:
+                await self.send(action)
+
+    def choose_step(self):
+        """Choose a direction to walk in."""
+        if not self.teleporter or self.world != 'The Light World':
+            return self.rng.choice(list(DIRECTIONS))
+        tx, ty = TELEPORTER_POS[0]
+        x, y = self.pos
+        towards = []
+        if tx != x:
+            towards.append('east' if tx > x else 'west')
+        if ty != y:
+            towards.append('south' if ty > y else 'north')
+        # Wander sometimes, to find a way round obstacles
+        if not towards or self.rng.random() < 0.3:
+            return self.rng.choice(list(DIRECTIONS))
+        return self.rng.choice(towards)
+
+    async def act(self):
+        """Act on whatever is in front of us, or use the teleporter."""
+        if self.teleporter and self.pos == TELEPORTER_POS[0]:
+            # Face the trigger, which is north of the first teleporter
+            await self.send('north')
+            await self.send('act')
+            self.busy_until = time.monotonic() + 3.0
+        else:
+            await self.send('act')
+
+    async def read(self):
+        async for m in self.ws:
+            if m.type != aiohttp.WSMsgType.TEXT:
+                break
+            now = time.monotonic()
+            self.stats.frames += 1
+            self.stats.bytes += len(m.data)
+            msg = json.loads(m.data)
+            if msg['op'] == 'batch':
+                for submsg in msg['msgs']:
+                    self.handle(submsg, now)
+            else:
+                self.handle(msg, now)
+        if not self.closing:
+            self.stats.disconnects += 1
+
+    def echoed(self, action, now):
+        times = self.pending[action]
+        if times:
+            self.stats.latency[action].append(now - times.popleft())
+
+    def handle(self, msg, now):
+        op = msg['op']
+        self.stats.received[op] += 1
+        if op == 'authfail':
+            self.stats.authfails += 1
+        elif op == 'refresh':
+            self.pos = tuple(msg['pos'])
+            world = msg['world'].get('title')
+            if world != self.world and self.world == 'The Light World':
+                self.stats.teleports += 1
+            self.world = world
+            self.echoed('refresh', now)
+        elif op == 'moved' and msg['track']:
+            self.pos = tuple(msg['to_pos'])
+            self.echoed('move', now)
+        elif op == 'say' and msg['user'] == self.name:
+            self.echoed('say', now)
+        elif op == 'dialog':
+            self.echoed('inventory', now)
+
+
+async def scrape(session, url):
+    """Get the server's metrics, as a dict of sample name to value."""
+    samples = {}
+    try:
+        async with session.get(url) as resp:
+            text = await resp.text()
+    except aiohttp.ClientError:
+        return samples
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def load_test(url, bots, duration, ramp, rates, teleporters, seed):
+    stats = Stats()
+    rng = random.Random(seed)
+    names = [f'bot_{i}_x' for i in range(bots)]
+    swarm = []
+    for i, name in enumerate(names):
+        teleporter = i < teleporters
+        bot = Bot(name, stats, rates, random.Random(rng.random()), teleporter)
+        swarm.append(bot)
+
+    async with aiohttp.ClientSession() as session:
+        before = await scrape(session, url + '/metrics')
+        start = time.monotonic()
+        until = start + ramp + duration
+        tasks = []
+        for i, bot in enumerate(swarm):
+            await asyncio.sleep(max(0, start + ramp * i / bots - time.monotonic()))
+            tasks.append(
+                asyncio.ensure_future(bot.run(session, url + '/ws', until))
+            )
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - start
+        after = await scrape(session, url + '/metrics')
+
+    server = {}
+    for name, title in SERVER_METRICS:
+        if name in after:
+            server[title] = after[name] - before.get(name, 0)
+    lag_count = after.get('darkworld_loop_lag_seconds_count', 0) - \
+        before.get('darkworld_loop_lag_seconds_count', 0)
+    if lag_count:
+        lag_sum = after['darkworld_loop_lag_seconds_sum'] - \
+            before.get('darkworld_loop_lag_seconds_sum', 0)
+        server['mean loop lag (ms)'] = lag_sum / lag_count * 1e3
+
+    latency = {}
+    for action, values in sorted(stats.latency.items()):
+        values.sort()
+        latency[action] = {
+            'count': len(values),
+            'lost': stats.lost[action],
+            **{
+                f'p{round(q * 100)}': percentile(values, q) * 1e3
+                for q in (0.5, 0.9, 0.99)
+            },
+            'max': values[-1] * 1e3,
+        }
+    return {
+        'bots': bots,
+        'seconds': elapsed,
+        'connected': stats.connected,
+        'failed': stats.failed,
+        'authfails': stats.authfails,
+        'disconnects': stats.disconnects,
+        'teleports': stats.teleports,
+        'sent': dict(stats.sent),
+        'latency_ms': latency,
+        'frames_per_second': stats.frames / elapsed,
+        'bytes_per_second': stats.bytes / elapsed,
+        'received_per_second': {
+            op: n / elapsed for op, n in stats.received.most_common()
+        },
+        'server': server,
+    }
+
+
+def print_report(r):
+    print(
+        f"{r['bots']} bots over {r['seconds']:.1f}s: "
+        f"{r['connected']} connected, {r['failed']} failed to connect, "
+        f"{r['authfails']} auth failures, {r['disconnects']} disconnected, "
+        f"{r['teleports']} teleports"
+    )
+    print()
+    print(f"{'action':10} {'echoed':>8} {'lost':>6} "
+          f"{'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  (ms)")
+    for action, s in r['latency_ms'].items():
+        print(
+            f"{action:10} {s['count']:8} {s['lost']:6} "
+            f"{s['p50']:8.1f} {s['p90']:8.1f} {s['p99']:8.1f} {s['max']:8.1f}"
+        )
+    print()
+    print(
+        f"Received {r['frames_per_second']:.1f} frames/s, "
+        f"{r['bytes_per_second'] / 1024:.1f} KiB/s"
+    )
+    for op, rate in r['received_per_second'].items():
+        print(f'    {op:12} {rate:10.1f}/s')
+    if r['server']:
+        print()
+        print('Server:')
+        for title, value in r['server'].items():
+            print(f'    {title:20} {value:10.1f}')
+
+
+@click.command()
+@click.option('--url', default='http://localhost:8000', show_default=True,
+              help='The server to test.')
+@click.option('--bots', default=20, show_default=True,
+              help='Number of bots to connect.')
+@click.option('--duration', default=60.0, show_default=True,
+              help='Seconds to run for once all bots have connected.')
+@click.option('--ramp', default=10.0, show_default=True,
+              help='Seconds over which to connect the bots.')
+@click.option('--move-rate', default=2.0, show_default=True,
+              help='Steps per second per bot.')
+@click.option('--act-rate', default=0.3, show_default=True,
+              help='Acts per second per bot.')
+@click.option('--say-rate', default=0.1, show_default=True,
+              help='Chat messages per second per bot.')
+@click.option('--inventory-rate', default=0.05, show_default=True,
+              help='Inventory opens per second per bot.')
+@click.option('--teleporters', default=0.1, show_default=True,
+              help='Fraction of bots that go to the dark world.')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed for the bots\' choices.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Write the report as JSON to this file.')
+def main(url, bots, duration, ramp, move_rate, act_rate, say_rate,
+         inventory_rate, teleporters, seed, output):
+    """Load test a running server with a swarm of bots."""
+    rates = {
+        'move': move_rate,
+        'act': act_rate,
+        'say': say_rate,
+        'inventory': inventory_rate,
+    }
+    rates = {k: v for k, v in rates.items() if v > 0}
+    report = asyncio.get_event_loop().run_until_complete(load_test(
+        url.rstrip('/'),
+        bots,
+        duration,
+        ramp,
+        rates,
+        round(bots * teleporters),
+        seed
+    ))
+    print_report(report)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 """Server for The Dark World game."""
 import sys
 
-if sys.version_info < (3, 6):
-    sys.exit("The Dark World requires Python 3.6 or later.")
+if sys.version_info < (3, 8):
+    sys.exit("The Dark World requires Python 3.8 or later.")
 
 from darkworld.serve import run_server
 